@@ -1,15 +1,42 @@
 import os 
 import pdb 
+import signal
+from datetime import datetime
+from urllib.parse import urlsplit
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, abort
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Follows, Likes
+from models import (db, connect_db, User, Message, Follows, Likes, Timeline, parse_cursor,
+                    reconcile_counters, user_card_columns)
+import timeline_cache
+from timeline_cache import connect_timelines
+from user_cache import connect_user_cache, load_current_user
+from passwords import connect_passwords, PasswordHasherBusy
+from search import get_search
+from query_stats import connect_query_stats
+from metrics import connect_metrics, TimedQueuePool
+from http_cache import connect_http_cache, conditional, VERSIONED_STATIC_MAX_AGE
+import fragment_cache
+from fragment_cache import connect_fragments
+import jobs
+from replicas import connect_replicas, replica_binds
+from redis_client import connect_redis
 
 CURR_USER_KEY = "curr_user"
 
+# Most users a search or an autocomplete lookup returns.
+MAX_SEARCH_RESULTS = 50
+MAX_AUTOCOMPLETE_RESULTS = 10
+
+# Most like toggles /likes/toggle accepts in one request.
+MAX_BULK_LIKES = 100
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -19,31 +46,128 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warblerdb_test'))
     
 
+# Read replicas (see replicas.py): comma-separated URLs that GET requests
+# read from, and how many seconds after a write its browser reads the primary
+app.config['SQLALCHEMY_BINDS'] = replica_binds(os.environ.get('DATABASE_REPLICA_URLS'))
+app.config['REPLICA_PIN_SECONDS'] = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# TimedQueuePool reports connection checkout waits to /metrics (see metrics.py)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
+# Connection pool of each worker process (see models.engine_options): size,
+# overflow, seconds to wait for a connection, seconds before a connection is
+# replaced, and whether to test connections before use
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') not in ('0', '')
+# Set when connecting through pgbouncer in transaction pooling mode
+app.config['DB_PGBOUNCER'] = bool(os.environ.get('DB_PGBOUNCER'))
+# Milliseconds a request's statement may run before Postgres cancels it (0: no limit)
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+# Pool checkouts waiting longer than this many ms get logged
+app.config['DB_SLOW_CHECKOUT_MS'] = float(os.environ.get('DB_SLOW_CHECKOUT_MS', 100))
+# Background jobs (see jobs.py): worker threads, seconds between polls,
+# seconds before a job whose worker died is run again, and seconds finished
+# jobs are kept; with JOBS_INLINE (or TESTING) they run inside the request
+app.config['JOB_THREADS'] = int(os.environ.get('JOB_THREADS', 4))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+app.config['JOB_LOCK_TIMEOUT'] = float(os.environ.get('JOB_LOCK_TIMEOUT', 300))
+app.config['JOB_RETENTION'] = float(os.environ.get('JOB_RETENTION', 24 * 3600))
+app.config['JOBS_INLINE'] = bool(os.environ.get('JOBS_INLINE'))
+# Deleted accounts are purged this many rows per transaction, and this many
+# transactions per job
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 1000))
+app.config['PURGE_BATCHES_PER_JOB'] = int(os.environ.get('PURGE_BATCHES_PER_JOB', 50))
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 30))
+# How message lists load their authors: 'joined' or 'selectin' (see models.Timeline)
+app.config['TIMELINE_AUTHOR_LOADER'] = os.environ.get('TIMELINE_AUTHOR_LOADER', 'joined')
+# Current-user snapshots (see user_cache.py): how many, and for how many seconds
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+# Password hashing (see passwords.py): bcrypt cost, hashing threads (default:
+# one per CPU), how many hashes may queue, and how long to wait for a slot
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 0)) or None
+app.config['BCRYPT_MAX_PENDING'] = int(os.environ.get('BCRYPT_MAX_PENDING', 0)) or None
+app.config['BCRYPT_QUEUE_WAIT'] = float(os.environ.get('BCRYPT_QUEUE_WAIT', 1.0))
+# Seconds before the in-process search index (used without pg_trgm) is rebuilt
+app.config['SEARCH_INDEX_TTL'] = float(os.environ.get('SEARCH_INDEX_TTL', 300))
+# SQL instrumentation (see query_stats.py): requests slower than this many ms
+# and statements repeated this often in one request get logged; aggregates
+# cover each endpoint's last SQL_STATS_WINDOW requests, served at /_sql_stats
+# if SQL_STATS_ENDPOINT is set
+app.config['SQL_SLOW_REQUEST_MS'] = float(os.environ.get('SQL_SLOW_REQUEST_MS', 500))
+app.config['SQL_REPEAT_THRESHOLD'] = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+app.config['SQL_STATS_WINDOW'] = int(os.environ.get('SQL_STATS_WINDOW', 1000))
+app.config['SQL_STATS_ENDPOINT'] = bool(os.environ.get('SQL_STATS_ENDPOINT'))
+# Seconds browsers may keep static files whose URLs aren't versioned
+# (versioned ones, from url_for, are kept for a year; see http_cache.py)
+app.config['STATIC_MAX_AGE'] = int(os.environ.get('STATIC_MAX_AGE', 24 * 3600))
+# How many rendered message items the in-process fragment cache keeps, and
+# for how many seconds (see fragment_cache.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = float(os.environ.get('FRAGMENT_CACHE_TTL', 24 * 3600))
+# Redis (a redis-py URL) for the timelines and rendered message items shared
+# by every worker process; without it each process keeps its own in memory
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+# Worker processes serving the app (gunicorn reads the same variable); the
+# in-process timeline store warns when there's more than one
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 1))
 toolbar = DebugToolbarExtension(app)
 
 with app.app_context():
     connect_db(app)  
     # pdb.set_trace() 
 
+connect_redis(app)
+connect_timelines(app)
+connect_user_cache(app)
+connect_passwords(app)
+connect_query_stats(app)
+connect_metrics(app)
+connect_http_cache(app)
+connect_fragments(app)
+connect_replicas(app)
+
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a cached snapshot (see user_cache.py), so this usually doesn't
+    touch the database; the full User row is loaded only if a route needs it.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    return "Too many sign-ins right now, please try again in a moment.", 503, {"Retry-After": "1"}
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    """No database connection freed up within DB_POOL_TIMEOUT seconds."""
+
+    return "We're busy right now, please try again in a moment.", 503, {"Retry-After": "1"}
+
+
 def do_login(user):
     """Log in user."""
 
@@ -141,6 +265,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password hash if authenticate() upgraded its cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -162,65 +288,160 @@ def logout():
 ##############################################################################
 # General user routes:
 
+
+def followed_ids(users):
+    """Ids among `users` that g.user follows, for rendering follow buttons."""
+
+    if not g.user:
+        return set()
+    return Follows.followed_among(g.user.id, [user.id for user in users])
+
 @app.route('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username;
+    results are ranked by similarity (see search.py). Without one, users
+    are listed a page at a time ('after' is the last id of the previous page).
     """
 
     search = request.args.get('q')
+    next_after = None
 
     if not search:
-        users = User.query.all()
+        users, next_after = User.directory(after=request.args.get('after', type=int),
+                                           per_page=app.config['USERS_PER_PAGE'])
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = users_by_ids(get_search().search(search, MAX_SEARCH_RESULTS))
+
+    return render_template('users/index.html', users=users,
+                           followed_ids=followed_ids(users), next_after=next_after)
+
+
+@app.route('/users/autocomplete')
+def users_autocomplete():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    prefix = request.args.get('q', '').strip()
+    if not prefix:
+        return jsonify(users=[])
+
+    users = users_by_ids(get_search().autocomplete(prefix, MAX_AUTOCOMPLETE_RESULTS))
+    return jsonify(users=[{"id": user.id, "username": user.username, "image_url": user.image_url}
+                          for user in users])
+
+
+def users_by_ids(user_ids):
+    """Load users by id, keeping the order of `user_ids`."""
+
+    users = {user.id: user for user in (User.query
+                                        .options(user_card_columns())
+                                        .filter(User.id.in_(user_ids),
+                                                User.deleted_at.is_(None)))}
+    return [users[id] for id in user_ids if id in users]
+
+
+def active_user_or_404(user_id):
+    """The user with `user_id`, or a 404 if there's none or it's being deleted."""
+
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        abort(404)
+    return user
+
+
+def active_message(message_id):
+    """The message with `message_id` and its author, or None if there's no
+    such message or its author is being deleted."""
+
+    return (Message.query
+            .join(Message.user)
+            .options(contains_eager(Message.user))
+            .filter(Message.id == message_id, User.deleted_at.is_(None))
+            .first())
+
 
-    return render_template('users/index.html', users=users)
+def viewer_ids():
+    """The logged-in user's id in a list, or an empty list."""
+
+    return [g.user.id] if g.user else []
+
+
+def profile_version(user_id):
+    """Version of a profile page: the user's and the viewer's update stamps.
+
+    Posting, deleting, following and liking all move users.updated_at, so
+    this catches every change the page shows.
+    """
+
+    stamps = User.change_stamps([user_id] + viewer_ids())
+    return stamps if any(stamp_id == user_id for stamp_id, stamp in stamps) else None
+
+
+def message_version(message_id):
+    """Version of a message page: its author's and the viewer's stamps.
+
+    Messages can't be edited, so only the author (name, picture) and the
+    viewer (following the author or not) can change.
+    """
+
+    author_id = select(Message.user_id).where(Message.id == message_id).scalar_subquery()
+    return User.change_stamps([author_id] + viewer_ids()) or None
 
 
 @app.route('/users/<int:user_id>')
+@conditional(profile_version)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    messages, likes, next_cursor = (Timeline
+                                    .profile(user_id)
+                                    .page(before=parse_cursor(request.args.get('before')),
+                                          per_page=app.config['MESSAGES_PER_PAGE']))
     # return render_template('users/show.html', user=user, messages=messages)
-    num_likes = Likes.query.filter_by(user_id=user_id).count()
     return render_template('users/show.html', user=user, messages=messages, 
                            bio=user.bio, location=user.location, 
-                           header_image_url=user.header_image_url, num_likes=num_likes)
+                           header_image_url=user.header_image_url, num_likes=user.likes_count,
+                           followed_ids=followed_ids([user]), next_cursor=next_cursor)
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time
+    (older follows via the `before` cursor)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = active_user_or_404(user_id)
+    following, next_cursor = User.follow_list(user_id,
+                                              before=parse_cursor(request.args.get('before')),
+                                              per_page=app.config['USERS_PER_PAGE'])
+    return render_template('users/following.html', user=user, following=following,
+                           followed_ids=followed_ids(following + [user]),
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time
+    (older follows via the `before` cursor)."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = active_user_or_404(user_id)
+    followers, next_cursor = User.follow_list(user_id, followers=True,
+                                              before=parse_cursor(request.args.get('before')),
+                                              per_page=app.config['USERS_PER_PAGE'])
+    return render_template('users/followers.html', user=user, followers=followers,
+                           followed_ids=followed_ids(followers + [user]),
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -231,9 +452,19 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = active_user_or_404(follow_id)
+    started = Follows.start(g.user.id, followed_user.id)
     db.session.commit()
+    timeline_cache.get_store().invalidate(g.user.id)
+
+    if started:
+        # warm the timeline again, with the new account's messages (the next
+        # home page visit rebuilds it anyway if that comes first)
+        if timeline_jobs():
+            jobs.enqueue('rebuild_timeline', user_id=g.user.id)
+            db.session.commit()
+        else:
+            timeline_cache.rebuild(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -246,10 +477,14 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.stop(g.user.id, follow_id)
     db.session.commit()
 
+    # Rebuilt on the next home page visit. Filtering the account's messages
+    # out of the cached list instead could leave it short, with older
+    # messages of the accounts still followed missing from it.
+    timeline_cache.get_store().invalidate(g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -270,7 +505,15 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Gone from logins and pages right away (message lists skip deleted
+    # authors); its rows are purged by the job, which also retracts its
+    # messages from shared timelines. In-process ones only this process can
+    # reach, and forgetting them costs one query.
+    g.user.load().deleted_at = datetime.utcnow()
+    timeline_cache.get_store().invalidate(g.user.id)
+    if not timeline_jobs():
+        timeline_cache.retract_author(g.user.id)
+    jobs.enqueue('delete_user', idempotency_key=f"delete_user:{g.user.id}", user_id=g.user.id)
     db.session.commit()
 
     return redirect("/signup")
@@ -293,9 +536,16 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        msg = Message.post(g.user.id, form.text.data)
+        db.session.flush()
+        if timeline_jobs():
+            # the author sees it now, followers once the job has run
+            jobs.enqueue('fan_out', message_id=msg.id)
+            db.session.commit()
+            timeline_cache.get_store().push([g.user.id], msg.id)
+        else:
+            db.session.commit()
+            timeline_cache.fan_out(msg)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -303,11 +553,15 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@conditional(message_version)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = active_message(message_id)
+    if msg is None:
+        abort(404)
+    return render_template('messages/show.html', message=msg,
+                           followed_ids=followed_ids([msg.user]))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -319,7 +573,9 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    timeline_cache.retract(msg)
+    fragment_cache.forget_message(msg)
+    msg.discard()
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
@@ -346,6 +602,7 @@ def user_edit(user_id):
             user.header_image_url = form.header_image_url.data or User.header_image_url.default.arg
             user.bio = form.bio.data
             user.location = form.location.data
+            user.profile_updated_at = datetime.utcnow()
 
             db.session.commit()
 
@@ -366,22 +623,35 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+      (older pages via the `before` cursor)
     """
 
     if g.user: 
-        followed_users = [followed_user.id for followed_user in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_users + [g.user.id]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all()) 
-        likes = [like.message_id for like in Likes.query.filter_by(user_id=g.user.id)]
-        return render_template('home.html', messages=messages, likes=likes)
+        messages, likes, next_cursor = home_timeline(parse_cursor(request.args.get('before')))
+        return render_template('home.html', messages=messages, likes=likes,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
+
+
+def home_timeline(before=None):
+    """One page of g.user's home timeline: (messages, liked_ids, next_cursor).
+
+    The first page's ids come from the precomputed timeline (timeline_cache.py);
+    older pages seek through the database with the keyset cursor.
+    """
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+
+    if before:
+        timeline = Timeline.home(g.user.id)
+    else:
+        message_ids = timeline_cache.home_message_ids(g.user.id, per_page + 1)
+        timeline = Timeline.of_ids(message_ids, viewer_id=g.user.id)
+
+    return timeline.page(before=before, per_page=per_page)
     
 ##############################################################################
 # Likes 
@@ -396,33 +666,87 @@ def add_like(message_id):
         form = LoginForm()
         return render_template('users/login.html', form=form)
 
-    message = Message.query.get(message_id)
+    message = active_message(message_id)
 
     if not message:
         flash('Message not found.', 'error')
         return render_template('home.html')
 
-    like = Likes.query.filter_by(user_id=g.user.id, message_id=message_id).first()
-
-    if like:
-        db.session.delete(like)
-        print("Deleted like!")
-    else:
-        like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(like)
+    liked, likes = Likes.toggle(g.user.id, message_id)
+    if liked:
         print("Added like!")
+    else:
+        print("Deleted like!")
 
     db.session.commit()
     print("Committed changes to database!")
-    followed_users = [followed_user.id for followed_user in g.user.following]
-    messages = (Message
-                .query
-                .filter(Message.user_id.in_(followed_users + [g.user.id]))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())  
-    likes = [like.message_id for like in Likes.query.filter_by(user_id=g.user.id)]
-    return render_template('home.html', messages=messages, likes=likes)
+
+    # This is the no-JavaScript fallback (see toggle_like): send the browser
+    # back where it came from instead of re-rendering a timeline here.
+    return redirect(local_referrer())
+
+
+def local_referrer(default="/"):
+    """Path of the page this request came from, if it's on this site."""
+
+    referrer = urlsplit(request.referrer or "")
+    if referrer.netloc != request.host or not referrer.path:
+        return default
+    return referrer.path + (f"?{referrer.query}" if referrer.query else "")
+
+
+@app.route('/messages/<int:message_id>/like', methods=['POST'])
+def toggle_like(message_id):
+    """Like/unlike a message and return just its new state as JSON.
+
+    Used by the like buttons' script in base.html; returns
+    {"message_id": ..., "liked": true/false, "likes": <count>}.
+    """
+
+    if not g.user:
+        return jsonify(error="You need to sign in first"), 401
+
+    message = active_message(message_id)
+    if not message:
+        return jsonify(error="Message not found"), 404
+
+    liked, likes = Likes.toggle(g.user.id, message_id)
+    db.session.commit()
+
+    return jsonify(message_id=message_id, liked=liked, likes=likes)
+
+
+@app.route('/likes/toggle', methods=['POST'])
+def toggle_likes():
+    """Apply several queued like toggles in one transaction.
+
+    Takes {"message_ids": [...]} (toggled in order, repeats allowed) and
+    returns {"likes": [state, ...]}, one entry per distinct message.
+    """
+
+    if not g.user:
+        return jsonify(error="You need to sign in first"), 401
+
+    message_ids = (request.get_json(silent=True) or {}).get("message_ids")
+    if (not isinstance(message_ids, list) or not message_ids or
+            len(message_ids) > MAX_BULK_LIKES or
+            not all(type(id) is int for id in message_ids)):
+        return jsonify(error=f"Expected 1-{MAX_BULK_LIKES} integer message_ids"), 400
+
+    found = {id for (id,) in (db.session.query(Message.id)
+                              .join(Message.user)
+                              .filter(Message.id.in_(message_ids), User.deleted_at.is_(None)))}
+    missing = sorted(set(message_ids) - found)
+    if missing:
+        return jsonify(error="Message not found", message_ids=missing), 404
+
+    states = {}
+    for message_id in message_ids:
+        liked, likes = Likes.toggle(g.user.id, message_id)
+        states[message_id] = {"message_id": message_id, "liked": liked, "likes": likes}
+    db.session.commit()
+
+    return jsonify(likes=list(states.values()))
 
 ##############################################################################
 # Liked Warbles 
@@ -430,17 +754,125 @@ def add_like(message_id):
 def users_liked_warbles(user_id):
     """Show messages liked by user."""
 
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+
+    messages, likes, next_cursor = (Timeline
+                                    .liked_by(user_id)
+                                    .page(before=parse_cursor(request.args.get('before')),
+                                          per_page=app.config['MESSAGES_PER_PAGE']))
+
+    return render_template('users/liked_warbles.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
+
+##############################################################################
+# Command line
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--user-id', type=int, multiple=True,
+              help="Only rebuild these users (can be repeated).")
+@click.option('--all', 'rebuild_all', is_flag=True,
+              help="Rebuild warm timelines too, not just cold ones.")
+def rebuild_timelines(user_id, rebuild_all):
+    """Build cached home timelines for cold users."""
+
+    store = timeline_cache.get_store()
+    user_ids = user_id or [id for (id,) in db.session.query(User.id)]
+    rebuilt = 0
+
+    for id in user_ids:
+        if rebuild_all or user_id or store.get(id, 1) is None:
+            timeline_cache.rebuild(id)
+            rebuilt += 1
+
+    click.echo(f"Rebuilt {rebuilt} timeline(s).")
+
 
-    messages = (Message
-                .query
-                .join(Likes)
-                .filter(Likes.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+@app.cli.command('run-jobs')
+@click.option('--threads', type=int, help="Jobs run at once (default: JOB_THREADS).")
+@click.option('--once', is_flag=True, help="Exit when no jobs are due instead of polling.")
+def run_jobs(threads, once):
+    """Run queued background jobs until stopped (SIGTERM waits for running ones)."""
+
+    worker = jobs.Worker(app,
+                         threads=threads or app.config['JOB_THREADS'],
+                         poll_interval=app.config['JOB_POLL_INTERVAL'],
+                         lock_timeout=app.config['JOB_LOCK_TIMEOUT'],
+                         retention=app.config['JOB_RETENTION'])
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        worker.run(once=once)
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute message/follow/like counters from the database."""
+
+    reconcile_counters()
+    db.session.commit()
+    click.echo("Counters reconciled.")
+
+##############################################################################
+# Background jobs (enqueued by the routes above, run by `flask run-jobs`)
+
+
+def timeline_jobs():
+    """Can timeline updates be left to `flask run-jobs`?
+
+    Only if the timeline store is shared (Redis): the worker is a separate
+    process, so with the in-process store its pushes and rebuilds would land
+    in its own memory and the web workers would never see them. Otherwise
+    routes do that work themselves.
+    """
+
+    return timeline_cache.get_store().shared
+
+
+@jobs.handler('fan_out')
+def fan_out_job(message_id):
+    """Push a new message onto its author's followers' timelines."""
+
+    msg = db.session.get(Message, message_id)
+    if msg:
+        timeline_cache.fan_out(msg, to_author=False)
+
+
+@jobs.handler('rebuild_timeline')
+def rebuild_timeline_job(user_id):
+    """Build a user's home timeline ahead of their next visit."""
+
+    timeline_cache.rebuild(user_id)
+
+
+@jobs.handler('delete_user')
+def delete_user_job(user_id, retracted=False):
+    """Purge a deleted account a batch (one transaction) at a time.
+
+    First, with a shared timeline store, its messages are retracted from
+    its followers' timelines, while the follows still say who they are.
+
+    Stops after PURGE_BATCHES_PER_JOB batches and queues itself again, so no
+    job runs anywhere near JOB_LOCK_TIMEOUT. If it's interrupted, the rerun
+    just carries on with whatever rows are left.
+    """
+
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is None:
+        return
+
+    if timeline_jobs() and not retracted:
+        timeline_cache.retract_author(user_id)
+
+    for _ in range(app.config['PURGE_BATCHES_PER_JOB']):
+        deleted = User.purge_batch(user_id, app.config['PURGE_BATCH_SIZE'])
+        if not deleted:
+            return
+        db.session.commit()
+
+    jobs.enqueue('delete_user', user_id=user_id, retracted=True)
 
-    return render_template('users/liked_warbles.html', user=user, messages=messages)
 
 ##############################################################################
 # Turn off all caching in Flask
@@ -451,11 +883,31 @@ def users_liked_warbles(user_id):
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request.
+
+    Static files are public: for a year if url_for versioned the URL, else
+    for STATIC_MAX_AGE seconds. Pages with a conditional() policy already
+    have their headers. Nothing else is stored, and pages for a logged-in
+    user are private.
+    """
+
+    if request.endpoint == 'static':
+        req.cache_control.no_cache = None
+        req.cache_control.public = True
+        if 'v' in request.args:
+            req.cache_control.max_age = VERSIONED_STATIC_MAX_AGE
+            req.cache_control.immutable = True
+        else:
+            req.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        return req
+
+    if req.get_etag()[0] is not None:
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    if g.get('user'):
+        req.cache_control.private = True
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
     return req
  
\ No newline at end of file
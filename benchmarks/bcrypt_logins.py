@@ -0,0 +1,84 @@
+"""Micro-benchmark: password checks (logins) per second per core.
+
+Drives PasswordHasher.check from several client threads for a fixed time,
+the way concurrent logins would, and reports throughput overall and per
+hashing core. Useful for picking BCRYPT_LOG_ROUNDS / BCRYPT_WORKERS.
+
+run it from the project root like:
+
+    python -m benchmarks.bcrypt_logins --rounds 12 --seconds 10
+"""
+
+import argparse
+import os
+import threading
+import time
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+def run(rounds, workers, clients, seconds):
+    """Return a dict of results for one benchmark run."""
+
+    hasher = PasswordHasher(rounds=rounds, workers=workers,
+                            max_pending=clients, wait=seconds)
+    pw_hash = hasher.hash("correct horse battery staple")
+
+    logins = []
+    rejected = []
+    deadline = time.monotonic() + seconds
+
+    def client():
+        done = busy = 0
+        while time.monotonic() < deadline:
+            try:
+                hasher.check(pw_hash, "correct horse battery staple")
+                done += 1
+            except PasswordHasherBusy:
+                busy += 1
+        logins.append(done)
+        rejected.append(busy)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    cores = min(hasher.workers, os.cpu_count() or 1)
+    per_second = sum(logins) / elapsed
+
+    return {
+        "rounds": rounds,
+        "workers": hasher.workers,
+        "clients": clients,
+        "seconds": round(elapsed, 2),
+        "logins": sum(logins),
+        "rejected": sum(rejected),
+        "logins_per_sec": round(per_second, 2),
+        "logins_per_sec_per_core": round(per_second / cores, 2),
+        "ms_per_login": round(1000 * elapsed * cores / max(sum(logins), 1), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt log rounds")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="hashing threads (default: one per CPU)")
+    parser.add_argument("--clients", type=int, default=None,
+                        help="concurrent login threads (default: 2 per worker)")
+    parser.add_argument("--seconds", type=float, default=5, help="how long to run")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    result = run(args.rounds, workers, args.clients or workers * 2, args.seconds)
+
+    for key, value in result.items():
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""Load test: latency, throughput and SQL counts per route.
+
+Seeds a database with the generator at the chosen scale, then has concurrent
+clients run a mixed workload against the WSGI app, in process, for a fixed
+time. Every client is logged in as a random seeded user and picks an action
+by weight:
+
+    home     GET  /                       (home timeline)
+    profile  GET  /users/<id>             (someone's warbles)
+    search   GET  /users?q=...            (username search)
+    like     POST /messages/<id>/like     (JSON like toggle)
+    follow   POST /users/follow/<id>, or  /users/stop-following/<id>
+    post     POST /messages/new
+
+For each action it reports p50/p95/p99 latency, throughput, errors and SQL
+statements per request, as JSON so runs can be compared across commits.
+
+Background jobs (see jobs.py) run inside the requests that queue them, so
+their cost is measured too. With --job-worker they're queued instead and run
+by a worker thread, which drains the queue once the clients stop; either way
+the report counts the jobs table by status, so jobs left undone show up.
+
+Seeding DROPS EVERY TABLE in the target database, so point it at a
+scratch one. run it from the project root like:
+
+    python -m benchmarks.routes --database-url postgresql:///warblerdb_bench \\
+        --users 10000 --messages 100000 --follows 300000 \\
+        --clients 8 --seconds 30 --output bench-$(git rev-parse --short HEAD).json
+
+and reuse the data on later runs with --no-seed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# (action, weight) for the default mix.
+WORKLOAD = [
+    ("home", 40),
+    ("profile", 20),
+    ("search", 10),
+    ("like", 15),
+    ("follow", 10),
+    ("post", 5),
+]
+
+
+def seed(database_url, users, messages, follows, data_seed):
+    """Generate CSVs at the given scale and load them with seed.py."""
+
+    env = dict(os.environ, DATABASE_URL=database_url)
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run([sys.executable, "generator/create_csvs.py",
+                        "--users", str(users), "--messages", str(messages),
+                        "--follows", str(follows), "--seed", data_seed,
+                        "--out-dir", data_dir], check=True, env=env)
+        subprocess.run([sys.executable, "seed.py", "--data-dir", data_dir],
+                       check=True, env=env)
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """Stats for a list of (seconds, status, statements) samples."""
+
+    latencies = sorted(round(seconds * 1000, 2) for seconds, status, statements in samples)
+    statements = [statements for seconds, status, statements in samples]
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for seconds, status, statements in samples if status >= 400),
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "sql_mean": round(sum(statements) / len(statements), 2) if statements else None,
+        "sql_max": max(statements, default=None),
+    }
+
+
+class Client:
+    """One simulated user, with its own cookie jar, making requests in a loop."""
+
+    def __init__(self, app, user_id, targets, rng):
+        from app import CURR_USER_KEY
+
+        self.client = app.test_client()
+        self.user_id = user_id
+        self.targets = targets
+        self.rng = rng
+        self.followed = []
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def home(self):
+        return self.client.get("/")
+
+    def profile(self):
+        return self.client.get(f"/users/{self.rng.randint(1, self.targets['max_user_id'])}")
+
+    def search(self):
+        username = self.rng.choice(self.targets['usernames'])
+        start = self.rng.randrange(max(1, len(username) - 3))
+        return self.client.get("/users", query_string={"q": username[start:start + 4]})
+
+    def like(self):
+        message_id = self.rng.randint(1, self.targets['max_message_id'])
+        return self.client.post(f"/messages/{message_id}/like")
+
+    def follow(self):
+        if self.followed and self.rng.random() < 0.5:
+            return self.client.post(f"/users/stop-following/{self.followed.pop()}")
+        other_id = self.rng.randint(1, self.targets['max_user_id'])
+        if other_id != self.user_id:
+            self.followed.append(other_id)
+        return self.client.post(f"/users/follow/{other_id}")
+
+    def post(self):
+        return self.client.post("/messages/new", data={"text": f"benchmark warble {self.rng.random()}"})
+
+
+def run(app, targets, clients, seconds, warmup, run_seed):
+    """Drive the workload; return {action: [(seconds, status, statements)]}."""
+
+    from models import db
+    from sqlalchemy import event
+
+    local = threading.local()
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+    actions = [action for action, weight in WORKLOAD]
+    weights = [weight for action, weight in WORKLOAD]
+    samples = {action: [] for action in actions}
+    lock = threading.Lock()
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + seconds
+
+    def worker(number):
+        rng = random.Random(f"{run_seed}:{number}")
+        client = Client(app, rng.choice(targets['user_ids']), targets, rng)
+        mine = {action: [] for action in actions}
+
+        while True:
+            started = time.monotonic()
+            if started >= deadline:
+                break
+            action = rng.choices(actions, weights)[0]
+            local.statements = 0
+            response = getattr(client, action)()
+            finished = time.monotonic()
+            if started >= measure_from:
+                mine[action].append((finished - started, response.status_code, local.statements))
+
+        with lock:
+            for action, results in mine.items():
+                samples[action].extend(results)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for engine in engines:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    return samples
+
+
+def load_targets(app, sample_size=1000):
+    """Ids and usernames the clients pick from."""
+
+    from sqlalchemy import func, select
+    from models import db, User, Message
+
+    with app.app_context():
+        users = db.session.execute(
+            select(User.id, User.username).order_by(func.random()).limit(sample_size)).all()
+        return {
+            "user_ids": [user_id for user_id, username in users],
+            "usernames": [username for user_id, username in users],
+            "max_user_id": db.session.scalar(select(func.max(User.id))),
+            "max_message_id": db.session.scalar(select(func.max(Message.id))) or 1,
+        }
+
+
+def run_job_worker(app):
+    """Start a jobs.Worker on a thread; returns (worker, thread)."""
+
+    import jobs
+
+    worker = jobs.Worker(app, threads=app.config['JOB_THREADS'], poll_interval=0.05)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    return worker, thread
+
+
+def drain_jobs(app, worker, thread):
+    """Stop the worker, then run the jobs still queued; returns the seconds it took."""
+
+    import jobs
+
+    started = time.monotonic()
+    worker.stop()
+    thread.join()
+    jobs.Worker(app, threads=app.config['JOB_THREADS'], poll_interval=0.05).run(once=True)
+    return round(time.monotonic() - started, 2)
+
+
+def job_counts(app):
+    """{status: count} of the jobs table."""
+
+    from sqlalchemy import func, select
+    from models import db, Job
+
+    with app.app_context():
+        return dict(db.session.execute(
+            select(Job.status, func.count()).group_by(Job.status)).all())
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", default=os.environ.get(
+        "BENCH_DATABASE_URL", "postgresql:///warblerdb_bench"),
+        help="scratch database (its tables are dropped when seeding)")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the data already there")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--follows", type=int, default=40000)
+    parser.add_argument("--seed", default="warbler", help="generator and workload seed")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--seconds", type=float, default=20, help="measured duration")
+    parser.add_argument("--warmup", type=float, default=3, help="unmeasured seconds first")
+    parser.add_argument("--job-worker", action="store_true",
+                        help="queue background jobs for a worker thread instead of "
+                             "running them inside the requests")
+    parser.add_argument("--output", help="write the JSON here (default: stdout)")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        seed(args.database_url, args.users, args.messages, args.follows, args.seed)
+
+    # app.py reads DATABASE_URL at import time
+    os.environ["DATABASE_URL"] = args.database_url
+    from app import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG'] = False
+    app.config['JOBS_INLINE'] = not args.job_worker
+
+    targets = load_targets(app)
+    if args.job_worker:
+        worker, worker_thread = run_job_worker(app)
+    samples = run(app, targets, args.clients, args.seconds, args.warmup, args.seed)
+    if args.job_worker:
+        drain_seconds = drain_jobs(app, worker, worker_thread)
+
+    result = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "users": args.users, "messages": args.messages, "follows": args.follows,
+            "seeded": not args.no_seed, "seed": args.seed, "clients": args.clients,
+            "seconds": args.seconds, "warmup": args.warmup, "workload": dict(WORKLOAD),
+            "jobs": "worker" if args.job_worker else "inline",
+        },
+        "jobs": job_counts(app),
+        "routes": {action: summarize(results, args.seconds) for action, results in samples.items()},
+        "total": summarize([sample for results in samples.values() for sample in results], args.seconds),
+    }
+
+    for action, stats in list(result["routes"].items()) + [("total", result["total"])]:
+        print(f"{action:>8}: {stats['requests']:6} req {stats['throughput_rps']:8} rps  "
+              f"p50 {stats['p50_ms']} p95 {stats['p95_ms']} p99 {stats['p99_ms']} ms  "
+              f"sql {stats['sql_mean']}", file=sys.stderr)
+
+    if args.job_worker:
+        result["jobs_drain_seconds"] = drain_seconds
+    print(f"    jobs: {result['jobs'] or 'none queued'}", file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Cache of rendered message list items.
+
+Every message list (home timeline, profile, liked warbles) used to render
+the same markup for each message on every request: avatar, @username,
+formatted date, text. Now that part is rendered once from
+`messages/item.html` and kept here. Pages only render what differs per
+viewer (the like button and count) around it.
+
+An item is keyed by message id and its author's `profile_updated_at`,
+which user_edit moves. The author row is loaded with every message list
+anyway, so the key costs no lookup, and an edit makes every item of theirs
+stop matching at once without anyone having to find them. The key comes
+from the same row the item is rendered from: a replica that hasn't seen an
+edit yet reads the old timestamp and gets (or stores) the old item, never
+the old markup under the new key. Messages can't be edited, so deleting
+one (`forget_message`) is the only other change.
+
+Two backends are provided: an in-process LRU (the default) and one that
+talks to any Redis-like client, shared by every worker (used when REDIS_URL
+is set, see redis_client.py). Both let entries expire after
+FRAGMENT_CACHE_TTL seconds. Profile edits reach every store through the
+key. `forget_message` only reaches the store it's called on, but deleted
+messages aren't listed anyway, so other workers' copies just sit unused
+until they expire.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+# Template each item is rendered from, with `message` in its context.
+ITEM_TEMPLATE = 'messages/item.html'
+
+# Seconds an entry is kept unless FRAGMENT_CACHE_TTL says otherwise.
+DEFAULT_TTL = 24 * 3600
+
+
+class FragmentStore:
+    """Interface every fragment backend implements: a string key/value store."""
+
+    def get_many(self, keys):
+        """{key: value} for those of `keys` that are stored."""
+
+        raise NotImplementedError
+
+    def set_many(self, mapping):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class InMemoryFragmentStore(FragmentStore):
+    """Bounded LRU in this process whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size=10000, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in mapping.items():
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisFragmentStore(FragmentStore):
+    """Fragments kept in Redis, shared by every worker.
+
+    `client` can be a redis-py client or anything else with mget/set/delete.
+    Entries expire after `ttl` seconds; Redis' maxmemory policy does the LRU.
+    """
+
+    def __init__(self, client, prefix="warbler:fragment:", ttl=DEFAULT_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: _text(value) for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def _text(value):
+    return value.decode('UTF-8') if isinstance(value, bytes) else value
+
+
+def connect_fragments(app, store=None):
+    """Attach a fragment store to the app: in Redis if connect_redis gave it
+    a client, else an in-process LRU."""
+
+    redis = app.extensions.get('redis')
+    if store is None and redis is not None:
+        store = RedisFragmentStore(redis, ttl=app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL))
+    elif store is None:
+        store = InMemoryFragmentStore(max_size=app.config.get('FRAGMENT_CACHE_SIZE', 10000),
+                                      ttl=app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL))
+
+    app.extensions['fragments'] = store
+    app.jinja_env.globals['message_items'] = message_items
+
+
+def get_store():
+    """Return the fragment store of the current app."""
+
+    return current_app.extensions['fragments']
+
+
+def _item_key(message):
+    return f"message:{message.id}:{message.user.profile_updated_at:%Y%m%d%H%M%S%f}"
+
+
+def message_items(messages):
+    """{message id: rendered item} for `messages`, from the cache if possible.
+
+    Called once per page from the templates, so a page costs one store
+    lookup however many messages it shows.
+    """
+
+    store = get_store()
+    keys = {message.id: _item_key(message) for message in messages}
+    found = store.get_many(keys.values())
+
+    template = current_app.jinja_env.get_template(ITEM_TEMPLATE)
+    rendered = {}
+    for message in messages:
+        key = keys[message.id]
+        if key not in found:
+            found[key] = rendered[key] = template.render(message=message)
+    if rendered:
+        store.set_many(rendered)
+
+    return {message_id: Markup(found[key]) for message_id, key in keys.items()}
+
+
+def forget_message(message):
+    """Drop a deleted message's item."""
+
+    get_store().delete(_item_key(message))
@@ -3,28 +3,62 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Generation is offline and deterministic: the same --seed, sizes and --end
+give byte-identical files, whatever --workers is. Rows are made in shards on
+a process pool, each shard with its own seeded random generator, and the
+shards are stitched together in order afterwards.
+
+- Follows point at users with a power-law (celebrity) skew: user k gets
+  followed in proportion to k ** -follow_skew.
+- Message timestamps lean towards --end (see helpers.get_random_datetime).
+
+run it from the project root like:
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 100000 --messages 2000000 \\
+        --follows 5000000 --workers 8 --out-dir /tmp/warbler
+    python seed.py --data-dir /tmp/warbler
+
+--format copy writes Postgres COPY text files (users.tsv, ...) instead:
+no header, columns in the *_CSV_HEADERS order, for `\\copy users (...) FROM`.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, power_law_id
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id', 'created_at']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
 
-fake = Faker()
+# Rows per shard (per unit of work handed to a process).
+SHARD_SIZE = 10000
 
-# Generate random profile image URLs to use for users
+# Random draws per wanted follow before the rest are filled in order.
+MAX_FOLLOW_DRAWS = 20
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +66,203 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users, saved from splashbase once so we
+# don't need the network (or splashbase) to generate data.
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'header_images.txt')) as urls:
+    header_image_urls = urls.read().split()
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+Options = namedtuple('Options', [
+    'seed', 'users', 'messages', 'follows', 'follow_skew', 'time_skew', 'years', 'end', 'format',
+])
+
+TABLES = [
+    ('users', USERS_CSV_HEADERS),
+    ('messages', MESSAGES_CSV_HEADERS),
+    ('follows', FOLLOWS_CSV_HEADERS),
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def user_rows(options, rng, fake, start, stop):
+    for user_id in range(start + 1, stop + 1):
+        # the id suffix keeps names unique without coordinating shards
+        username = f"{fake.user_name()}{user_id}"
+        yield [
+            user_id,
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def message_rows(options, rng, fake, start, stop):
+    for i in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(options.years, options.time_skew, options.end, rng),
+            rng.randint(1, options.users),
+        ]
+
+
+def follow_rows(options, rng, fake, start, stop):
+    """Follows made by users start+1..stop, sorted by follower.
+
+    Each shard owns its followers, so pairs can't repeat across shards; the
+    shard's share of the total is proportional to how many followers it has.
+
+    Pairs are drawn at random until MAX_FOLLOW_DRAWS draws per follow have
+    been spent. In a nearly complete graph the skewed draws almost always
+    repeat a pair, so whatever is still missing then is filled in with the
+    first free pairs (most followed users first).
+    """
+
+    users = options.users
+    wanted = options.follows * stop // users - options.follows * start // users
+    wanted = min(wanted, (stop - start) * (users - 1))
+
+    pairs = set()
+    for _ in range(MAX_FOLLOW_DRAWS * wanted):
+        if len(pairs) >= wanted:
+            break
+        follower = rng.randint(start + 1, stop)
+        followed = power_law_id(users, options.follow_skew, rng)
+        if followed != follower:
+            pairs.add((follower, followed))
+
+    if len(pairs) < wanted:
+        free = ((follower, followed)
+                for followed in range(1, users + 1)
+                for follower in range(start + 1, stop + 1)
+                if followed != follower and (follower, followed) not in pairs)
+        pairs.update(list(itertools.islice(free, wanted - len(pairs))))
+
+    for follower, followed in sorted(pairs):
+        yield [followed, follower,
+               get_random_datetime(options.years, options.time_skew, options.end, rng)]
+
+
+ROWS = {'users': user_rows, 'messages': message_rows, 'follows': follow_rows}
+
+
+def copy_escape(value):
+    """A value in Postgres COPY text format."""
+
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def write_shard(options, table, start, stop, path):
+    """Write rows start..stop of `table` to `path` (runs in a worker process)."""
+
+    shard_seed = f"{options.seed}:{table}:{start}"
+    rng = random.Random(shard_seed)
+    fake = Faker()
+    fake.seed_instance(shard_seed)
+
+    with open(path, 'w', newline='') as part:
+        if options.format == 'csv':
+            write = csv.writer(part).writerow
+        else:
+            def write(row):
+                part.write('\t'.join(copy_escape(value) for value in row) + '\n')
+
+        for row in ROWS[table](options, rng, fake, start, stop):
+            write(row)
+
+    return stop - start
+
+
+def shards(options, table, shard_size):
+    """(start, stop) ranges each worker generates for `table`."""
+
+    if table == 'follows':
+        # shard by follower, sized so a shard holds about shard_size follows
+        total = options.users
+        shard_size = max(1, shard_size * options.users // max(options.follows, 1))
+    else:
+        total = getattr(options, table)
+    return [(start, min(start + shard_size, total)) for start in range(0, total, shard_size)]
+
+
+def generate(options, out_dir, workers, shard_size=SHARD_SIZE):
+    """Generate every table into `out_dir`."""
+
+    os.makedirs(out_dir, exist_ok=True)
+    parts_dir = tempfile.mkdtemp(prefix='.parts-', dir=out_dir)
+    extension = 'csv' if options.format == 'csv' else 'tsv'
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = {
+                table: [pool.submit(write_shard, options, table, start, stop,
+                                    os.path.join(parts_dir, f"{table}-{start:012d}"))
+                        for start, stop in shards(options, table, shard_size)]
+                for table, headers in TABLES
+            }
+
+            for table, headers in TABLES:
+                started = time.monotonic()
+                path = os.path.join(out_dir, f"{table}.{extension}")
+                with open(path, 'w', newline='') as output:
+                    if options.format == 'csv':
+                        csv.writer(output).writerow(headers)
+                    for future in jobs[table]:
+                        future.result()
+                    # stitch the parts in shard order
+                    for part_name in sorted(os.listdir(parts_dir)):
+                        if part_name.startswith(f"{table}-"):
+                            part_path = os.path.join(parts_dir, part_name)
+                            with open(part_path, newline='') as part:
+                                shutil.copyfileobj(part, output)
+                            os.remove(part_path)
+                print(f"{path}: done in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate random Warbler data offline.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', default='warbler', help="same seed, same data")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="generator processes (default: one per CPU)")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help="rows per unit of work; changing it changes the data")
+    parser.add_argument('--follow-skew', type=float, default=1.1,
+                        help="power-law exponent of who gets followed (0 = uniform)")
+    parser.add_argument('--time-skew', type=float, default=2.0,
+                        help="how strongly messages lean towards --end (1 = uniform)")
+    parser.add_argument('--years', type=int, default=2, help="how far back messages go")
+    parser.add_argument('--end', type=date.fromisoformat, default=date.today(),
+                        help="latest message date, YYYY-MM-DD (default: today)")
+    parser.add_argument('--format', choices=['csv', 'copy'], default='csv')
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
+
+    if args.users < 2 and args.follows:
+        parser.error("follows need at least two users")
+    if args.follows > args.users * (args.users - 1):
+        parser.error(f"{args.users} users can make at most {args.users * (args.users - 1)} follows")
+
+    options = Options(
+        seed=args.seed,
+        users=args.users,
+        messages=args.messages,
+        follows=args.follows,
+        follow_skew=args.follow_skew,
+        time_skew=args.time_skew,
+        years=args.years,
+        end=datetime.combine(args.end, datetime.min.time()),
+        format=args.format,
+    )
+    generate(options, args.out_dir, args.workers, args.shard_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,37 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, skew=1.0, now=None, rng=random):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    With `skew` above 1 the times bunch up towards `now` (recent activity
+    outweighs old), the way real timelines look; 1 is uniform.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    now = now or datetime.now()
+    try:
+        then = now.replace(year=now.year - year_gap)
+    except ValueError:
+        # `now` is Feb 29 and that year isn't a leap year
+        then = now.replace(year=now.year - year_gap, day=28)
+    age = rng.random() ** skew * (now - then).total_seconds()
+
+    return now - timedelta(seconds=age)
+
+
+def power_law_id(count, alpha, rng=random):
+    """A random id in 1..count where id k is picked in proportion to k**-alpha.
+
+    Low ids are the "celebrities". Uses the inverse CDF of a continuous
+    bounded power law, so each draw is O(1) however big `count` is.
+    """
+
+    if alpha == 1:
+        rank = count ** rng.random()
+    else:
+        exponent = 1 - alpha
+        rank = ((count ** exponent - 1) * rng.random() + 1) ** (1 / exponent)
+    return min(int(rank), count)
@@ -0,0 +1,94 @@
+"""HTTP caching: conditional GETs for pages, long-lived static files.
+
+A route decorated with `conditional(version)` gets ETag and Last-Modified
+headers. `version(**view_args)` must be cheap: one small query for the
+update stamps of whatever the page shows (usually `users.updated_at`, which
+moves with every change to a user, counters included), or None when the
+page doesn't exist. If the browser already has that version, it gets a
+304 and the view never runs.
+
+The ETag covers the version, the viewer and the templates, so a logged-in
+user never gets someone else's page and a deploy changes every ETag. Such
+pages are `private, no-cache`: browsers keep them but check back every
+time, and shared caches don't keep them. Pages with a pending flash message
+are always rendered, so the message gets shown.
+
+`url_for('static', ...)` adds ?v=<mtime> to the URL, so add_header can let
+those be cached for a year.
+"""
+
+import hashlib
+import os
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+# Cache lifetime of static URLs that carry a ?v=<mtime> version.
+VERSIONED_STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+def conditional(version):
+    """Answer 304 Not Modified when the page's `version` hasn't changed."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(**view_args):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(**view_args)
+
+            stamps = version(**view_args)
+            if stamps is None:
+                return view(**view_args)
+
+            viewer_id = g.user.id if g.user else None
+            templates_changed = current_app.extensions['http_cache']
+            etag = hashlib.sha1(repr((request.endpoint, viewer_id, stamps,
+                                      templates_changed)).encode()).hexdigest()
+            last_modified = max([templates_changed] + [stamp for key, stamp in stamps])
+
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response(view(**view_args))
+            else:
+                response = make_response("", 304)
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            if viewer_id is None:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True
+            response.vary.add('Cookie')
+            return response
+
+        return wrapped
+
+    return decorator
+
+
+def _templates_changed(app):
+    """When a template was last changed (naive UTC, like the stamps)."""
+
+    newest = 0
+    for folder, dirs, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        for name in files:
+            newest = max(newest, os.stat(os.path.join(folder, name)).st_mtime)
+    return datetime.utcfromtimestamp(int(newest))
+
+
+def _version_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        try:
+            values['v'] = int(os.stat(os.path.join(current_app.static_folder,
+                                                   values['filename'])).st_mtime)
+        except OSError:
+            pass
+
+
+def connect_http_cache(app):
+    """Version static URLs and note the templates' age for ETags."""
+
+    app.extensions['http_cache'] = _templates_changed(app)
+    app.url_defaults(_version_static_urls)
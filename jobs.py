@@ -0,0 +1,197 @@
+"""Background jobs, kept in the `jobs` table and run by `flask run-jobs`.
+
+Routes hand off side effects that needn't finish before the response:
+
+    jobs.enqueue('fan_out', message_id=msg.id)
+    db.session.commit()
+
+The job row is written in the route's own transaction, so it exists exactly
+when the route's changes were committed. Handlers are functions registered
+with `@handler(name)`. They get the payload as keyword arguments and run in
+an app context, and their changes are committed along with the job's 'done'.
+
+Workers claim due jobs with `SELECT ... FOR UPDATE SKIP LOCKED` on Postgres,
+so several of them can poll one table without ever claiming the same job.
+SQLite has one writer at a time, so there a claim is a conditional UPDATE.
+A job that raises is retried with exponential backoff, up to max_attempts,
+then left 'failed' with its error. If a worker dies mid-job, the job is
+claimed again after JOB_LOCK_TIMEOUT seconds, so handlers must cope with
+running twice.
+
+Enqueueing with an idempotency key that's already in the table does nothing.
+
+With JOBS_INLINE set, or in TESTING, `enqueue` runs the handler right away
+in the caller's transaction instead.
+"""
+
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+# Longest wait between retries of a failing job, in seconds.
+MAX_BACKOFF = 3600
+
+# Seconds between an idle worker's sweeps of old done jobs.
+PRUNE_INTERVAL = 60
+
+HANDLERS = {}
+
+
+def handler(name):
+    """Register the decorated function as the handler of `name` jobs."""
+
+    def register(function):
+        HANDLERS[name] = function
+        return function
+
+    return register
+
+
+def enqueue(name, idempotency_key=None, delay=0, max_attempts=5, **payload):
+    """Add a `name` job to the current transaction; commit to submit it."""
+
+    if name not in HANDLERS:
+        raise KeyError(f"No job handler named {name!r}")
+
+    if current_app.config.get('JOBS_INLINE') or current_app.testing:
+        HANDLERS[name](**payload)
+        return
+
+    values = dict(name=name, payload=payload, idempotency_key=idempotency_key,
+                  status='queued', attempts=0, max_attempts=max_attempts,
+                  run_at=datetime.utcnow() + timedelta(seconds=delay))
+    if db.session.get_bind().dialect.name == 'postgresql':
+        insert = pg_insert(Job)
+    else:
+        insert = sqlite_insert(Job)
+    db.session.execute(insert.values(values).on_conflict_do_nothing())
+
+
+def _claimable(now, lock_timeout):
+    return or_(and_(Job.status == 'queued', Job.run_at <= now),
+               and_(Job.status == 'running',
+                    Job.locked_at < now - timedelta(seconds=lock_timeout)))
+
+
+def claim(limit, lock_timeout=300):
+    """Mark up to `limit` due jobs as running; returns their ids."""
+
+    now = datetime.utcnow()
+    due = (select(Job.id)
+           .where(_claimable(now, lock_timeout))
+           .order_by(Job.run_at)
+           .limit(limit))
+    if db.session.get_bind().dialect.name == 'postgresql':
+        due = due.with_for_update(skip_locked=True)
+
+    job_ids = db.session.scalars(due).all()
+    if job_ids:
+        # re-checked, so two SQLite pollers can't both claim a job
+        job_ids = db.session.scalars(
+            update(Job)
+            .where(Job.id.in_(job_ids), _claimable(now, lock_timeout))
+            .values(status='running', locked_at=now, attempts=Job.attempts + 1)
+            .returning(Job.id)
+            .execution_options(synchronize_session=False)).all()
+    db.session.commit()
+    return job_ids
+
+
+def perform(job_id):
+    """Run a claimed job, then mark it done, or queued again, or failed."""
+
+    job = db.session.get(Job, job_id)
+    try:
+        if job.attempts > job.max_attempts:
+            raise RuntimeError("Gave up after its worker stopped responding")
+        HANDLERS[job.name](**job.payload)
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return True
+
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("Job #%s (%s) failed", job_id, job.name)
+        db.session.rollback()
+
+        job = db.session.get(Job, job_id)
+        job.last_error = error
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=min(2 ** job.attempts, MAX_BACKOFF))
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return False
+
+
+def prune(retention):
+    """Delete jobs that finished successfully over `retention` seconds ago."""
+
+    deleted = db.session.execute(
+        delete(Job)
+        .where(Job.status == 'done',
+               Job.finished_at < datetime.utcnow() - timedelta(seconds=retention))
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return deleted
+
+
+class Worker:
+    """Polls for due jobs and runs them on a pool of `threads` threads."""
+
+    def __init__(self, app, threads=4, poll_interval=1.0, lock_timeout=300, retention=24 * 3600):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.retention = retention
+        self._stopping = threading.Event()
+        self._pruned_at = 0
+
+    def run(self, once=False):
+        """Run jobs until `stop()` (or, with `once`, until none are due)."""
+
+        running = set()
+        with ThreadPoolExecutor(self.threads, thread_name_prefix='job') as pool:
+            while not self._stopping.is_set():
+                running = {future for future in running if not future.done()}
+                job_ids = []
+                if len(running) < self.threads:
+                    with self.app.app_context():
+                        job_ids = claim(self.threads - len(running), self.lock_timeout)
+                running.update(pool.submit(self._perform, job_id) for job_id in job_ids)
+
+                if once and not running:
+                    break
+                if running:
+                    wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                elif not job_ids:
+                    if time.monotonic() - self._pruned_at > PRUNE_INTERVAL:
+                        with self.app.app_context():
+                            prune(self.retention)
+                        self._pruned_at = time.monotonic()
+                    self._stopping.wait(self.poll_interval)
+
+    def stop(self):
+        """Stop claiming jobs; `run` returns once the running ones finish."""
+
+        self._stopping.set()
+
+    def _perform(self, job_id):
+        with self.app.app_context():
+            return perform(job_id)
@@ -0,0 +1,150 @@
+"""Prometheus metrics, served at /metrics.
+
+- warbler_request_duration_seconds{endpoint, method, status}: histogram
+  of time spent serving each request
+- warbler_requests_in_flight: requests being served right now
+- warbler_db_pool_checkout_seconds: waits for a pooled DB connection
+  (the engine uses TimedQueuePool, see app.py); each response also carries
+  its own total as `Server-Timing: pool;dur=<ms>`
+- warbler_bcrypt_seconds{operation} / warbler_bcrypt_queue_seconds: time
+  spent hashing or checking passwords, and waiting for a hashing thread
+- warbler_template_render_seconds{template}: render_template time
+
+Under gunicorn, point PROMETHEUS_MULTIPROC_DIR at an empty directory that
+every worker can write to, before the app is imported. Each worker then
+keeps its numbers in its own mmap'd files there, and /metrics (whichever
+worker answers) adds them all up. Clear the directory on every restart,
+and have the gunicorn config drop dead workers' gauges:
+
+    from prometheus_client import multiprocess
+
+    def child_exit(server, worker):
+        multiprocess.mark_process_dead(worker.pid)
+
+/metrics isn't authenticated; keep it off the public internet.
+"""
+
+import logging
+import os
+import time
+
+from flask import (Response, before_render_template, g, has_request_context, request,
+                   template_rendered)
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = Histogram(
+    'warbler_request_duration_seconds', "Time spent serving a request.",
+    ['endpoint', 'method', 'status'])
+
+REQUESTS_IN_FLIGHT = Gauge(
+    'warbler_requests_in_flight', "Requests being served right now.",
+    multiprocess_mode='livesum')
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    'warbler_db_pool_checkout_seconds', "Time spent waiting for a pooled database connection.",
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+BCRYPT_SECONDS = Histogram(
+    'warbler_bcrypt_seconds', "Time spent hashing or checking a password.",
+    ['operation'], buckets=(.025, .05, .1, .25, .5, 1, 2.5, 5))
+
+BCRYPT_QUEUE_SECONDS = Histogram(
+    'warbler_bcrypt_queue_seconds', "Time a password hash waited for a hashing thread.",
+    buckets=(.001, .01, .05, .1, .25, .5, 1, 2.5, 5))
+
+TEMPLATE_SECONDS = Histogram(
+    'warbler_template_render_seconds', "Time spent rendering a template.",
+    ['template'], buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited.
+
+    Waits go to the histogram and to the request's Server-Timing header
+    (`pool;dur=<ms>`); ones over `slow_checkout` seconds are logged with the
+    pool's state.
+    """
+
+    slow_checkout = 0.1
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            POOL_CHECKOUT_SECONDS.observe(waited)
+            if has_request_context():
+                g.pool_wait = g.get('pool_wait', 0) + waited
+            if waited > self.slow_checkout:
+                logger.warning("Waited %.0f ms for a database connection: %s",
+                               waited * 1000, self.status())
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+def _observe_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        REQUEST_SECONDS.labels(request.endpoint or 'unmatched', request.method,
+                               response.status_code).observe(time.perf_counter() - started)
+        REQUESTS_IN_FLIGHT.dec()
+    pool_wait = g.pop('pool_wait', None)
+    if pool_wait is not None:
+        response.headers.add('Server-Timing', f'pool;dur={pool_wait * 1000:.1f}')
+    return response
+
+
+def _request_failed(error):
+    # after_request doesn't run when the response couldn't be made
+    if g.pop('metrics_started', None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+def _start_render(sender, template, context, **extra):
+    g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+
+def _observe_render(sender, template, context, **extra):
+    renders = g.get('metrics_renders')
+    if renders:
+        TEMPLATE_SECONDS.labels(template.name).observe(time.perf_counter() - renders.pop())
+
+
+def _observe_bcrypt(operation, waited, seconds):
+    BCRYPT_QUEUE_SECONDS.observe(waited)
+    BCRYPT_SECONDS.labels(operation).observe(seconds)
+
+
+def show_metrics():
+    """Every metric, in Prometheus' text format."""
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def connect_metrics(app):
+    """Collect request, template and password metrics for the app."""
+
+    app.before_request(_start_request)
+    app.after_request(_observe_request)
+    app.teardown_request(_request_failed)
+
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_observe_render, app)
+
+    app.extensions['passwords'].on_timing = _observe_bcrypt
+    TimedQueuePool.slow_checkout = app.config.get('DB_SLOW_CHECKOUT_MS', 100) / 1000
+
+    app.add_url_rule('/metrics', 'metrics', show_metrics)
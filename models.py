@@ -1,11 +1,37 @@
 """SQLAlchemy models for warblerdb."""
+from collections import Counter
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
+from flask import current_app, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event, exists, func, select, text, tuple_, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import contains_eager, load_only, selectinload
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import get_hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def adjust_counters(model, ids, **deltas):
+    """Add `deltas` to the counter columns of the `model` rows in `ids`.
+
+    Done as an UPDATE in the current transaction (`counter = counter + n`),
+    so concurrent requests can't overwrite each other's increments. `ids`
+    can be a list or a select of ids.
+
+    Users given by a list have their current-user snapshots dropped once
+    the transaction commits (see user_cache.py); ones given by a select
+    catch up when their snapshot expires.
+    """
+
+    values = {name: getattr(model, name) + delta for name, delta in deltas.items()}
+    db.session.execute(update(model).where(model.id.in_(ids)).values(values))
+    if model is User and isinstance(ids, (list, tuple, set)):
+        db.session.info.setdefault('changed_user_ids', set()).update(ids)
 
 
 class Follows(db.Model):
@@ -25,27 +51,180 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # In UTC, like every other timestamp here. The server default only covers
+    # rows bulk-loaded without it, and gives the same time as the Python one
+    # whatever the database session's time zone, so the two sort together.
+    # Databases created before this column: see upgrade_schema.sql.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.timezone('utc', func.now()),
+    )
+
+    @classmethod
+    def start(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`, updating both counters.
+
+        Returns False (and changes nothing) if they already follow them.
+        The row is added with INSERT ... ON CONFLICT DO NOTHING, so if two
+        requests race to make the same follow, the loser just gets False.
+        """
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            insert = pg_insert(cls)
+        else:
+            insert = sqlite_insert(cls)
+        inserted = db.session.execute(
+            insert
+            .values(user_being_followed_id=followed_id, user_following_id=follower_id)
+            .on_conflict_do_nothing()
+            .returning(cls.user_following_id)).first()
+        if inserted is None:
+            return False
+
+        adjust_counters(User, [follower_id], following_count=1)
+        adjust_counters(User, [followed_id], followers_count=1)
+        return True
+
+    @classmethod
+    def stop(cls, follower_id, followed_id):
+        """Make `follower_id` stop following `followed_id`, updating counters.
+
+        Returns False if they weren't following them.
+        """
+
+        result = db.session.execute(
+            delete(cls)
+            .where(cls.user_being_followed_id == followed_id,
+                   cls.user_following_id == follower_id)
+            .execution_options(synchronize_session=False))
+        if not result.rowcount:
+            return False
+
+        adjust_counters(User, [follower_id], following_count=-1)
+        adjust_counters(User, [followed_id], followers_count=-1)
+        return True
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? Returns a set.
+
+        One primary-key lookup restricted to the given ids, so a page of user
+        cards can check follow state with a set lookup per card.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+
+# Following/followers pages list one side's follows newest first, by
+# (created_at, other user's id). The first also serves "whom does X follow"
+# for home timelines without visiting the table.
+db.Index('ix_follows_following_created_at', Follows.user_following_id,
+         Follows.created_at.desc(), Follows.user_being_followed_id.desc())
+db.Index('ix_follows_followed_created_at', Follows.user_being_followed_id,
+         Follows.created_at.desc(), Follows.user_following_id.desc())
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    # (user_id, message_id) is the primary key, so a message can only be
+    # liked once per user and "did they like it?" is an index lookup; the
+    # message_id index serves the per-message side (counts, cascades).
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        # unique=True
+        primary_key=True,
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message, or unlike it if already liked.
+
+        Keeps the user's and the message's like counters in step.
+        Returns (liked, likes): whether the message is now liked and its
+        new like count.
+
+        On Postgres this is a single statement (see _TOGGLE_LIKE_SQL). If two
+        toggles race, the loser's INSERT hits ON CONFLICT DO NOTHING and
+        changes nothing, so there's never a duplicate row or a drifted count.
+        """
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            delta, likes = db.session.execute(
+                _TOGGLE_LIKE_SQL,
+                {"user_id": user_id, "message_id": message_id, "now": datetime.utcnow()}).one()
+            return delta >= 0, likes
+
+        deleted = db.session.execute(
+            delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .execution_options(synchronize_session=False)).rowcount
+        if deleted:
+            delta = -1
+        else:
+            delta = db.session.execute(
+                sqlite_insert(cls)
+                .values(user_id=user_id, message_id=message_id)
+                .on_conflict_do_nothing()).rowcount
+
+        if delta:
+            adjust_counters(User, [user_id], likes_count=delta)
+            adjust_counters(Message, [message_id], likes_count=delta)
+
+        likes = db.session.scalar(select(Message.likes_count).where(Message.id == message_id))
+        return delta >= 0, likes
+
+
+# Delete the like if it's there, otherwise insert it, then move both
+# counters by the difference (+1, -1, or 0 if a concurrent toggle won).
+# Data-modifying CTEs all run, so this is one statement and one round trip.
+_TOGGLE_LIKE_SQL = text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING 1
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), delta AS (
+        SELECT (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS n
+    ), user_counter AS (
+        UPDATE users SET likes_count = likes_count + delta.n, updated_at = :now
+        FROM delta
+        WHERE users.id = :user_id AND delta.n <> 0
+    ), message_counter AS (
+        UPDATE messages SET likes_count = likes_count + delta.n
+        FROM delta
+        WHERE messages.id = :message_id
+        RETURNING messages.likes_count
     )
+    SELECT delta.n, (SELECT likes_count FROM message_counter) FROM delta
+""")
 
 
 class User(db.Model):
@@ -95,7 +274,65 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message') 
+    # Denormalized counters, kept up to date by the follow/like/message
+    # helpers (and recomputed by `reconcile_counters`), so profile pages
+    # don't need to load whole relationships just to count them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Moves on every change to the row, counters included, so pages that
+    # show a user can answer conditional GETs from it (see http_cache.py).
+    # The server default only covers rows bulk-loaded by seed.py.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=func.timezone('utc', func.now()),
+    )
+
+    # Moves only when the user edits what their messages show (username,
+    # avatar): rendered message items are keyed by it (see fragment_cache.py).
+    profile_updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=func.timezone('utc', func.now()),
+    )
+
+    # Set when the account is deleted; its rows are then purged in the
+    # background (see `purge_batch`) and the user row goes last.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    messages = db.relationship('Message')
 
     followers = db.relationship(
         "User",
@@ -116,14 +353,12 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return bool(Follows.followed_among(other_user.id, [self.id]))
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return bool(Follows.followed_among(self.id, [other_user.id]))
 
     @classmethod
     # def signup(cls, username, email, password, image_url):
@@ -133,7 +368,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = get_hasher().hash(password)
          
         user = User(
             username=username,
@@ -157,17 +392,159 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different BCRYPT_LOG_ROUNDS than
+        the current one, it's replaced with a fresh hash; the caller's commit
+        saves it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            hasher = get_hasher()
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
+    @classmethod
+    def change_stamps(cls, user_ids):
+        """[(id, updated_at)] of those of `user_ids` that exist, by id.
+
+        `user_ids` may include scalar subqueries. One indexed lookup, cheap
+        enough to run before a page to see whether it changed. The users
+        are kept in the session, so if the page does get rendered, its own
+        lookups of them don't query again.
+        """
+
+        users = db.session.scalars(select(cls).where(cls.id.in_(user_ids)).order_by(cls.id)).all()
+        # the identity map only holds weak references
+        db.session.info.setdefault('stamped_users', []).extend(users)
+        return [(user.id, user.updated_at) for user in users]
+
+    @classmethod
+    def directory(cls, after=None, per_page=30):
+        """One page of the /users directory, in id order.
+
+        Seeks past the `after` id instead of using an OFFSET, and loads only
+        the columns a user card shows. Returns (users, next_after); next_after
+        is None on the last page.
+        """
+
+        query = cls.query.options(user_card_columns()).filter(cls.deleted_at.is_(None))
+        if after:
+            query = query.filter(cls.id > after)
+
+        users = query.order_by(cls.id).limit(per_page + 1).all()
+        if len(users) > per_page:
+            return users[:per_page], users[per_page - 1].id
+        return users, None
+
+    @classmethod
+    def follow_list(cls, user_id, followers=False, before=None, per_page=30):
+        """One page of whom `user_id` follows (or who follows them).
+
+        Most recent follow first. Seeks past the `before` cursor
+        ("<followed at>,<user id>", see parse_cursor) along an index on
+        (user, created_at, other user), and loads only the columns a user
+        card shows, so every page costs the same however many follows there
+        are. Returns (users, next_cursor); next_cursor is None on the last page.
+        """
+
+        if followers:
+            own_id, other_id = Follows.user_being_followed_id, Follows.user_following_id
+        else:
+            own_id, other_id = Follows.user_following_id, Follows.user_being_followed_id
+
+        query = (db.session.query(cls, Follows.created_at)
+                 .options(user_card_columns())
+                 .join(Follows, other_id == cls.id)
+                 .filter(own_id == user_id, cls.deleted_at.is_(None)))
+        if before:
+            query = query.filter(tuple_(Follows.created_at, other_id) < before)
+
+        rows = (query
+                .order_by(Follows.created_at.desc(), other_id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        users = [user for (user, followed_at) in rows[:per_page]]
+        next_cursor = None
+        if len(rows) > per_page:
+            user, followed_at = rows[per_page - 1]
+            next_cursor = f"{followed_at.isoformat()},{user.id}"
+        return users, next_cursor
+
+    @staticmethod
+    def purge_batch(user_id, batch_size=1000):
+        """Delete up to `batch_size` rows left behind by a deleted account.
+
+        Goes through its follows, its likes, the likes of its messages and
+        then its messages, taking each batch of rows out of the other side's
+        counters as it goes; once nothing is left, deletes the user row.
+        Each call touches at most about 2 x `batch_size` rows, so the caller
+        can commit after every call and pick up where it left off at any
+        time. Returns how many rows went, 0 once the user row is gone.
+        """
+
+        their_messages = select(Message.id).where(Message.user_id == user_id)
+        steps = (
+            (Follows, Follows.user_following_id == user_id,
+             Follows.user_being_followed_id, User, 'followers_count'),
+            (Follows, Follows.user_being_followed_id == user_id,
+             Follows.user_following_id, User, 'following_count'),
+            (Likes, Likes.user_id == user_id,
+             Likes.message_id, Message, 'likes_count'),
+            (Likes, Likes.message_id.in_(their_messages),
+             Likes.user_id, User, 'likes_count'),
+            (Message, Message.user_id == user_id,
+             Message.id, None, None),
+        )
+
+        for model, condition, other_id, counted_model, counter in steps:
+            other_ids = _delete_batch(model, condition, other_id, batch_size)
+            if not other_ids:
+                continue
+
+            if counted_model is not None:
+                by_count = {}
+                for other, count in Counter(other_ids).items():
+                    by_count.setdefault(count, []).append(other)
+                for count, ids in by_count.items():
+                    adjust_counters(counted_model, ids, **{counter: -count})
+            return len(other_ids)
+
+        db.session.execute(delete(User)
+                           .where(User.id == user_id, User.deleted_at.is_not(None))
+                           .execution_options(synchronize_session='fetch'))
+        return 0
+
+
+def _delete_batch(model, condition, returning, limit):
+    """DELETE ... WHERE <pk> IN (SELECT <pk> ... LIMIT n); returns `returning` of each row."""
+
+    primary_key = list(model.__table__.primary_key.columns)
+    batch = select(*primary_key).where(condition).limit(limit)
+    key = primary_key[0] if len(primary_key) == 1 else tuple_(*primary_key)
+    return db.session.scalars(
+        delete(model)
+        .where(key.in_(batch))
+        .returning(returning)
+        .execution_options(synchronize_session=False)).all()
+
+
+def user_card_columns():
+    """Loader option for just what a user card needs.
+
+    Leaves out the password hash, email, location and counters.
+    """
+
+    return load_only(User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -187,7 +564,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -196,14 +573,344 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
     user = db.relationship('User', overlaps="messages") 
 
+    @classmethod
+    def post(cls, user_id, text):
+        """Add a message by `user_id`, counting it on their profile."""
+
+        msg = cls(text=text, user_id=user_id)
+        db.session.add(msg)
+        adjust_counters(User, [user_id], messages_count=1)
+        return msg
+
+    def discard(self):
+        """Delete this message, uncounting it (and its likes)."""
+
+        adjust_counters(User, [self.user_id], messages_count=-1)
+        adjust_counters(User,
+                        select(Likes.user_id).where(Likes.message_id == self.id),
+                        likes_count=-1)
+        db.session.delete(self)
+
+    @property
+    def cursor(self):
+        """Keyset cursor pointing just past this message (see `paginate`)."""
+
+        return f"{self.timestamp.isoformat()},{self.id}"
+
+
+# Message lists are read newest first by (timestamp, id). A profile reads
+# one author's; a home timeline reads each followed author's, or walks all
+# messages newest first until the page is full, whichever is cheaper.
+db.Index('ix_messages_user_id_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id.desc())
+db.Index('ix_messages_timestamp', Message.timestamp.desc(), Message.id.desc())
+
+
+def parse_cursor(value):
+    """Turn a `before` query param ("<timestamp>,<id>") into a tuple.
+
+    Returns None if there's no cursor or it can't be parsed.
+    """
+
+    try:
+        timestamp, message_id = value.rsplit(",", 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Timeline:
+    """A newest-first listing of messages, shared by every route that shows one.
+
+    Each page is fetched with a single statement: the messages, their authors
+    (joined in, so templates can use `msg.user` for free) and, when there's a
+    viewer, whether the viewer liked each message. Who counts as "followed"
+    is worked out by a subquery, so no users are loaded into Python.
+    Messages of deleted accounts (still waiting to be purged) are left out.
+
+    How authors are loaded is set by the TIMELINE_AUTHOR_LOADER config:
+    "joined" (the default, one statement) or "selectin" (a second
+    `SELECT ... WHERE users.id IN (...)`, which avoids repeating the author
+    columns on every row). Either way it's a fixed number of statements per
+    page, never one per author.
+    """
+
+    AUTHOR_LOADERS = ("joined", "selectin")
+
+    def __init__(self, criterion, viewer_id=None):
+        self.criterion = criterion
+        self.viewer_id = viewer_id
+
+    @classmethod
+    def home(cls, user_id):
+        """Messages by `user_id` and by everyone they follow."""
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id))
+        return cls((Message.user_id == user_id) | Message.user_id.in_(followed),
+                   viewer_id=user_id)
+
+    @classmethod
+    def profile(cls, user_id, viewer_id=None):
+        """Messages written by `user_id`."""
+
+        return cls(Message.user_id == user_id, viewer_id)
+
+    @classmethod
+    def liked_by(cls, user_id, viewer_id=None):
+        """Messages `user_id` has liked."""
+
+        liked = select(Likes.message_id).where(Likes.user_id == user_id)
+        return cls(Message.id.in_(liked), viewer_id)
+
+    @classmethod
+    def of_ids(cls, message_ids, viewer_id=None):
+        """Messages with the given ids (e.g. from the timeline cache)."""
+
+        return cls(Message.id.in_(message_ids), viewer_id)
+
+    def message_ids(self, limit):
+        """Just the ids of the newest `limit` messages."""
+
+        rows = (db.session
+                .query(Message.id)
+                .join(Message.user)
+                .filter(self.criterion, User.deleted_at.is_(None))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit))
+        return [message_id for (message_id,) in rows]
+
+    def page(self, before=None, per_page=20, author_loader=None):
+        """Fetch one page: (messages, liked_ids, next_cursor).
+
+        Instead of an OFFSET this seeks past the `before` cursor with
+        `(timestamp, id) < (...)`, so page 50 costs the same as page one.
+        next_cursor is None on the last page.
+        """
+
+        columns = [Message]
+        if self.viewer_id is not None:
+            columns.append(exists()
+                           .where(Likes.message_id == Message.id,
+                                  Likes.user_id == self.viewer_id)
+                           .label("liked"))
+
+        author_loader = author_loader or current_app.config.get('TIMELINE_AUTHOR_LOADER', 'joined')
+        if author_loader not in self.AUTHOR_LOADERS:
+            raise ValueError(f"Unknown author loader {author_loader!r}")
+
+        query = (db.session.query(*columns)
+                 .join(Message.user)
+                 .filter(self.criterion, User.deleted_at.is_(None)))
+
+        if author_loader == "joined":
+            query = query.options(contains_eager(Message.user))
+        else:
+            query = query.options(selectinload(Message.user))
+
+        if before:
+            query = query.filter(tuple_(Message.timestamp, Message.id) < before)
+
+        rows = (query
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        if self.viewer_id is None:
+            messages, liked_ids = rows, set()
+        else:
+            messages = [msg for (msg, liked) in rows]
+            liked_ids = {msg.id for (msg, liked) in rows if liked}
+
+        next_cursor = None
+        if len(messages) > per_page:
+            messages = messages[:per_page]
+            next_cursor = messages[-1].cursor
+
+        return messages, liked_ids, next_cursor
+
+
+class Job(db.Model):
+    """A background job waiting for, or run by, a worker (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    # Workers look for due jobs by status and run_at.
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Name of the handler that runs it
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Keyword arguments for the handler
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # Enqueueing a job with a key that's already here does nothing
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # 'queued', 'running', 'done' or 'failed'
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    # Not to be run before this (set further out after each failure)
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # When a worker claimed it
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
+
+def reconcile_counters():
+    """Recompute every denormalized counter from the underlying rows.
+
+    One bulk UPDATE per table; use it after loading data behind the app's
+    back (seed.py) or to repair drift. Each child table is grouped once and
+    joined in, rather than counted per row, so it stays linear on freshly
+    loaded tables that don't have their indexes yet.
+    """
+
+    def counted(column):
+        return (select(column.label('id'), func.count().label('n'))
+                .group_by(column)
+                .subquery())
+
+    def totals(model, **columns):
+        counts = {name: counted(column) for name, column in columns.items()}
+        query = select(model.id.label('id'),
+                       *(func.coalesce(sub.c.n, 0).label(name) for name, sub in counts.items()))
+        for sub in counts.values():
+            query = query.outerjoin(sub, sub.c.id == model.id)
+        return query.subquery()
+
+    users = totals(User,
+                   messages_count=Message.user_id,
+                   following_count=Follows.user_following_id,
+                   followers_count=Follows.user_being_followed_id,
+                   likes_count=Likes.user_id)
+    db.session.execute(
+        update(User)
+        .where(User.id == users.c.id)
+        .values({name: users.c[name] for name in
+                 ('messages_count', 'following_count', 'followers_count', 'likes_count')})
+        .execution_options(synchronize_session=False))
+
+    messages = totals(Message, likes_count=Likes.message_id)
+    db.session.execute(
+        update(Message)
+        .where(Message.id == messages.c.id)
+        .values(likes_count=messages.c.likes_count)
+        .execution_options(synchronize_session=False))
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS, with the pool set up from the DB_* settings.
+
+    Every worker process has its own pool of DB_POOL_SIZE connections plus
+    up to DB_MAX_OVERFLOW more under load, so workers x (size + overflow)
+    must stay under Postgres' max_connections (or pgbouncer's client limit).
+
+    With DB_PGBOUNCER (transaction pooling), consecutive transactions may
+    run on different server connections, so nothing may outlive one:
+    server-side prepared statements are turned off (psycopg 3 makes them;
+    psycopg2 never does) and the statement timeout is set per transaction.
+    """
+
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    options.update(pool_size=config['DB_POOL_SIZE'],
+                   max_overflow=config['DB_MAX_OVERFLOW'],
+                   pool_timeout=config['DB_POOL_TIMEOUT'],
+                   pool_recycle=config['DB_POOL_RECYCLE'],
+                   pool_pre_ping=config['DB_POOL_PRE_PING'])
+
+    driver = make_url(config['SQLALCHEMY_DATABASE_URI']).get_driver_name()
+    if config['DB_PGBOUNCER'] and driver == 'psycopg':
+        options['connect_args'] = {**options.get('connect_args', {}), 'prepare_threshold': None}
+
+    return options
+
+
+def _limit_statements(connection):
+    """Cap each statement of a request's transaction at DB_STATEMENT_TIMEOUT_MS.
+
+    SET LOCAL ends with the transaction, so it's safe behind pgbouncer and
+    leaves CLI commands (seeding, reconciling) without a limit.
+    """
+
+    if has_request_context() and connection.dialect.name == 'postgresql':
+        timeout = int(current_app.config['DB_STATEMENT_TIMEOUT_MS'])
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {timeout}")
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
     You should call this in your Flask app.
     """
 
+    if 'DB_POOL_SIZE' in app.config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
     db.app = app
     db.init_app(app)
+
+    if app.config.get('DB_STATEMENT_TIMEOUT_MS'):
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, 'begin', _limit_statements)
     
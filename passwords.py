@@ -0,0 +1,113 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is slow on purpose (about 250ms per hash at 12 rounds). Hashing runs
+on a small thread pool (bcrypt releases the GIL, so the threads really do
+use separate cores) instead of on however many request threads happen to be
+logging in at once. That caps the CPU spent on hashing at BCRYPT_WORKERS
+cores, leaving the rest for serving pages. At most BCRYPT_MAX_PENDING hashes
+may be queued or running. Past that, callers wait up to BCRYPT_QUEUE_WAIT
+seconds for a slot, and then PasswordHasherBusy is raised (the app answers
+503) rather than letting a login storm pile up.
+
+The cost comes from BCRYPT_LOG_ROUNDS; hashes made with a different cost are
+upgraded on the next successful login (see User.authenticate).
+
+Set `on_timing` to a callable(operation, waited, seconds) to be told how long
+each hash or check queued for and then took (see metrics.py).
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from flask import current_app
+
+# bcrypt only looks at the first 72 bytes; older versions truncated silently
+# and newer ones raise, so truncate ourselves to keep existing hashes valid.
+MAX_PASSWORD_BYTES = 72
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing/checking on a bounded thread pool."""
+
+    def __init__(self, rounds=12, workers=None, max_pending=None, wait=1.0):
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.wait = wait
+        self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                        thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending or self.workers * 4)
+        self.on_timing = None
+
+    def _run(self, operation, fn, *args):
+        queued = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy("Too many password checks in progress")
+        try:
+            result, started, finished = self._pool.submit(_timed, fn, *args).result()
+        finally:
+            self._slots.release()
+
+        if self.on_timing is not None:
+            self.on_timing(operation, started - queued, finished - started)
+        return result
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run('hash', bcrypt.hashpw, _encode(password), salt).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`? False for malformed hashes."""
+
+        try:
+            return self._run('check', bcrypt.checkpw, _encode(password), pw_hash.encode('UTF-8'))
+        except ValueError:
+            return False
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than the configured one?"""
+
+        return cost_of(pw_hash) != self.rounds
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, started, time.perf_counter()
+
+
+def _encode(password):
+    return password.encode('UTF-8')[:MAX_PASSWORD_BYTES]
+
+
+def cost_of(pw_hash):
+    """The log-rounds cost stored in a bcrypt hash ("$2b$12$..." -> 12)."""
+
+    try:
+        return int(pw_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def connect_passwords(app):
+    """Attach a password hasher configured from the app's config."""
+
+    app.extensions['passwords'] = PasswordHasher(
+        rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+        workers=app.config.get('BCRYPT_WORKERS'),
+        max_pending=app.config.get('BCRYPT_MAX_PENDING'),
+        wait=app.config.get('BCRYPT_QUEUE_WAIT', 1.0))
+
+
+def get_hasher():
+    """Return the password hasher of the current app."""
+
+    return current_app.extensions['passwords']
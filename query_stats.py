@@ -0,0 +1,190 @@
+"""Per-request SQL instrumentation.
+
+Cursor events on the engine count every statement a request runs and time
+it. For each request we then:
+
+- add a `Server-Timing: db;dur=...;desc="N statements"` header, so the
+  numbers show up in the browser's network panel;
+- warn about statements run SQL_REPEAT_THRESHOLD or more times with only
+  their parameters changing (the signature of an N+1 query);
+- warn about requests slower than SQL_SLOW_REQUEST_MS;
+- fold the numbers into rolling per-endpoint aggregates over the last
+  SQL_STATS_WINDOW requests, served as JSON at /_sql_stats when
+  SQL_STATS_ENDPOINT is on.
+
+Statements run outside a request (CLI commands, tests) are ignored.
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from flask import current_app, g, has_request_context, jsonify, request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+_PARAMETERS = re.compile(r"%\(\w+\)s|%s|\?")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """`statement` with its parameters and literals replaced by `?`.
+
+    Lists collapse to `(?)`, so `IN (1, 2)` and `IN (3, 4, 5)` count as the
+    same statement.
+    """
+
+    statement = _PARAMETERS.sub("?", statement)
+    statement = _LITERALS.sub("?", statement)
+    statement = _LISTS.sub("(?)", statement)
+    return _SPACE.sub(" ", statement).strip()
+
+
+class RequestQueries:
+    """The statements of one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def add(self, statement, seconds):
+        self.statements += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold):
+        """[(times, fingerprint)] of statements run at least `threshold` times."""
+
+        return [(times, statement) for statement, times in self.fingerprints.most_common()
+                if times >= threshold]
+
+
+def _mean(values):
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def _p95(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 2)
+
+
+class QueryStats:
+    """Rolling per-endpoint aggregates over the last `window` requests."""
+
+    def __init__(self, window=1000, slow_ms=500, repeat_threshold=5):
+        self.slow_ms = slow_ms
+        self.repeat_threshold = repeat_threshold
+        self._recent = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, queries, request_ms):
+        """Log anything suspicious about one request and add it to the aggregates."""
+
+        repeated = queries.repeated(self.repeat_threshold)
+        for times, statement in repeated:
+            logger.warning("Possible N+1 in %s: %d x %s", endpoint, times, statement[:300])
+
+        db_ms = queries.seconds * 1000
+        if request_ms >= self.slow_ms:
+            logger.warning("Slow request %s: %.0fms, %d statements, %.0fms in SQL",
+                           endpoint, request_ms, queries.statements, db_ms)
+
+        with self._lock:
+            self._recent[endpoint].append((queries.statements, db_ms, request_ms, bool(repeated)))
+
+    def snapshot(self):
+        """{endpoint: aggregates} over each endpoint's recent requests."""
+
+        with self._lock:
+            recent = {endpoint: list(samples) for endpoint, samples in self._recent.items()}
+
+        snapshot = {}
+        for endpoint, samples in sorted(recent.items()):
+            statements, db_ms, request_ms, repeated = zip(*samples)
+            snapshot[endpoint] = {
+                "requests": len(samples),
+                "statements_mean": _mean(statements),
+                "statements_max": max(statements),
+                "db_ms_mean": _mean(db_ms),
+                "db_ms_p95": _p95(db_ms),
+                "request_ms_mean": _mean(request_ms),
+                "request_ms_p95": _p95(request_ms),
+                "repeated_statement_requests": sum(repeated),
+            }
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries.add(statement, time.perf_counter() - started)
+
+
+def _handle_error(context):
+    # after_cursor_execute doesn't run for a failed statement
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def _start_request():
+    g.sql_queries = RequestQueries()
+
+
+def _finish_request(response):
+    queries = g.pop('sql_queries', None)
+    if queries is None:
+        return response
+
+    request_ms = (time.perf_counter() - queries.started) * 1000
+    get_query_stats().record(request.endpoint or request.path, queries, request_ms)
+    response.headers.add('Server-Timing', f'db;dur={queries.seconds * 1000:.1f};'
+                                          f'desc="{queries.statements} statements"')
+    return response
+
+
+def connect_query_stats(app):
+    """Instrument the app's engines (primary and replicas) and requests."""
+
+    app.extensions['query_stats'] = QueryStats(
+        window=app.config.get('SQL_STATS_WINDOW', 1000),
+        slow_ms=app.config.get('SQL_SLOW_REQUEST_MS', 500),
+        repeat_threshold=app.config.get('SQL_REPEAT_THRESHOLD', 5))
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    if app.config.get('SQL_STATS_ENDPOINT'):
+        app.add_url_rule('/_sql_stats', 'sql_stats',
+                         lambda: jsonify(get_query_stats().snapshot()))
+
+
+def get_query_stats():
+    """Return the SQL aggregates of the current app."""
+
+    return current_app.extensions['query_stats']
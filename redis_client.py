@@ -0,0 +1,35 @@
+"""The Redis connection shared by the timeline and fragment stores.
+
+With REDIS_URL set, home timelines (timeline_cache.py) and rendered message
+items (fragment_cache.py) live in Redis, where every worker process (and the
+`flask run-jobs` worker) sees the same ones. Without it, each process keeps
+its own in memory.
+
+The redis package is only needed when REDIS_URL is set.
+"""
+
+from flask import current_app
+
+
+def connect_redis(app, client=None):
+    """Attach a Redis client made from REDIS_URL (None without one).
+
+    Call it before connect_timelines/connect_fragments, which use it.
+    """
+
+    url = app.config.get('REDIS_URL')
+    if client is None and url:
+        try:
+            import redis
+        except ImportError as error:
+            raise RuntimeError("REDIS_URL is set but the redis package isn't installed "
+                               "(pip install redis)") from error
+        client = redis.Redis.from_url(url)
+
+    app.extensions['redis'] = client
+
+
+def get_redis():
+    """Return the Redis client of the current app, or None."""
+
+    return current_app.extensions.get('redis')
@@ -0,0 +1,115 @@
+"""Read replicas: GET requests read from a replica, writes go to the primary.
+
+Replicas are extra Flask-SQLAlchemy binds named `replica_<n>` (app.py builds
+them from DATABASE_REPLICA_URLS). With none configured, everything uses the
+primary as before.
+
+RoutingSession sends a statement to a replica only when all of these hold:
+
+- it runs inside a GET/HEAD request,
+- it's a read (not a flush, not an INSERT/UPDATE/DELETE),
+- this session hasn't written anything yet,
+- the browser isn't pinned to the primary, and `use_primary()` wasn't called.
+
+Replicas lag a little behind. So that people see their own posts, likes and
+follows, any request that commits pins its browser (a timestamp in the Flask
+session) to the primary for REPLICA_PIN_SECONDS.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+# Bind keys starting with this are replicas.
+BIND_PREFIX = 'replica_'
+
+# Flask session key holding the time until which reads use the primary.
+PIN_KEY = 'primary_until'
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for a comma-separated list of replica URLs."""
+
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    return {f"{BIND_PREFIX}{number}": url for number, url in enumerate(urls)}
+
+
+class Replicas:
+    """The replica engines of an app and how long writes pin to the primary."""
+
+    def __init__(self, engines, pin_seconds=5):
+        self.engines = list(engines)
+        self.pin_seconds = pin_seconds
+
+    def choose(self):
+        return random.choice(self.engines)
+
+
+class RoutingSession(Session):
+    """Session that reads from a replica when that's safe (see module doc)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self._can_use_replica(clause):
+            return current_app.extensions['replicas'].choose()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _can_use_replica(self, clause):
+        if not has_request_context() or not g.get('read_replica'):
+            return False
+        if self._flushing or isinstance(clause, UpdateBase):
+            # whatever this transaction reads next must see the write
+            self.info['wrote'] = True
+        return not self.info.get('wrote')
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _note_commit(session):
+    session.info.pop('wrote', None)
+    if has_request_context():
+        g.db_committed = True
+
+
+def use_primary():
+    """Read from the primary for the rest of this request."""
+
+    if has_request_context():
+        g.read_replica = False
+
+
+def _choose_reads():
+    replicas = current_app.extensions['replicas']
+    g.read_replica = (bool(replicas.engines) and request.method in READ_METHODS and
+                      session.get(PIN_KEY, 0) < time.time())
+
+
+def _pin_after_commit(response):
+    pin_seconds = current_app.extensions['replicas'].pin_seconds
+    if g.pop('db_committed', False) and pin_seconds:
+        session[PIN_KEY] = time.time() + pin_seconds
+    return response
+
+
+def connect_replicas(app):
+    """Route reads to the app's `replica_*` binds (if any)."""
+
+    with app.app_context():
+        engines = app.extensions['sqlalchemy'].engines
+        replicas = [engines[key] for key in sorted(engines, key=str)
+                    if key and key.startswith(BIND_PREFIX)]
+
+    app.extensions['replicas'] = Replicas(replicas,
+                                          pin_seconds=app.config.get('REPLICA_PIN_SECONDS', 5))
+    app.before_request(_choose_reads)
+    app.after_request(_pin_after_commit)
+
+
+def get_replicas():
+    """Return the replica set of the current app."""
+
+    return current_app.extensions['replicas']
@@ -0,0 +1,274 @@
+"""Username search for the /users directory and autocomplete.
+
+`LIKE '%q%'` can't use a B-tree index, so every search used to scan the
+whole users table. There are two backends instead:
+
+- TrigramSearch (Postgres): a pg_trgm GIN index on users.username serves
+  both fuzzy (`%`) and substring (ILIKE) matches, ranked by similarity().
+  Prefix autocomplete uses a B-tree on lower(username).
+- NgramIndex (SQLite/dev, or Postgres without pg_trgm): the same trigram
+  idea as an in-process inverted index, plus a sorted list of usernames
+  for prefix lookups. Kept current by mapper events and rebuilt every
+  SEARCH_INDEX_TTL seconds so other processes' signups show up.
+
+Both return user ids, best match first.
+"""
+
+import bisect
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import event, func, text
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+TRIGRAM_INDEX = 'ix_users_username_trgm'
+PREFIX_INDEX = 'ix_users_username_prefix'
+
+# Same default as pg_trgm's `%` operator (pg_trgm.similarity_threshold).
+SIMILARITY_THRESHOLD = 0.3
+
+
+def trigrams(word):
+    """The trigrams of `word`, the way pg_trgm makes them.
+
+    Lowercased, padded with two spaces in front and one behind:
+    "Bob" -> {"  b", " bo", "bob", "ob "}.
+    """
+
+    padded = f"  {word.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _escape_like(value):
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+
+class UserSearch:
+    """Interface every search backend implements."""
+
+    def search(self, query, limit):
+        """Ids of users whose username matches `query`, best first."""
+
+        raise NotImplementedError
+
+    def autocomplete(self, prefix, limit):
+        """Ids of users whose username starts with `prefix`, alphabetically."""
+
+        raise NotImplementedError
+
+
+class TrigramSearch(UserSearch):
+    """Search backed by the pg_trgm GIN index on users.username."""
+
+    def search(self, query, limit):
+        similarity = func.similarity(User.username, query)
+        rows = (db.session
+                .query(User.id)
+                .filter(User.username.op('%')(query) |
+                        User.username.icontains(query, autoescape=True))
+                .order_by(similarity.desc(), User.id)
+                .limit(limit))
+        return [user_id for (user_id,) in rows]
+
+    def autocomplete(self, prefix, limit):
+        name = func.lower(User.username)
+        rows = (db.session
+                .query(User.id)
+                .filter(name.like(_escape_like(prefix.lower()) + "%", escape="\\"))
+                .order_by(name)
+                .limit(limit))
+        return [user_id for (user_id,) in rows]
+
+
+class NgramIndex(UserSearch):
+    """In-process trigram inverted index over usernames.
+
+    Fine for development-sized tables; it holds every username in memory,
+    so production should use TrigramSearch.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._names = {}
+        self._postings = defaultdict(set)
+        self._sorted = []
+
+    def _ensure_built(self):
+        if self._built_at is not None and time.monotonic() - self._built_at < self.ttl:
+            return
+
+        rows = db.session.query(User.id, User.username).all()
+        with self._lock:
+            self._names = {}
+            self._postings = defaultdict(set)
+            self._sorted = []
+            for user_id, username in rows:
+                self._add(user_id, username)
+            self._sorted.sort()
+            self._built_at = time.monotonic()
+
+    def _add(self, user_id, username, keep_sorted=False):
+        self._names[user_id] = username
+        for gram in trigrams(username):
+            self._postings[gram].add(user_id)
+        entry = (username.lower(), user_id)
+        if keep_sorted:
+            bisect.insort(self._sorted, entry)
+        else:
+            self._sorted.append(entry)
+
+    def _remove(self, user_id):
+        username = self._names.pop(user_id, None)
+        if username is None:
+            return
+        for gram in trigrams(username):
+            self._postings[gram].discard(user_id)
+        entry = (username.lower(), user_id)
+        i = bisect.bisect_left(self._sorted, entry)
+        if i < len(self._sorted) and self._sorted[i] == entry:
+            del self._sorted[i]
+
+    def update(self, user_id, username):
+        """Index a new or renamed user."""
+
+        with self._lock:
+            if self._built_at is None:
+                return
+            self._remove(user_id)
+            self._add(user_id, username, keep_sorted=True)
+
+    def remove(self, user_id):
+        """Drop a deleted user."""
+
+        with self._lock:
+            if self._built_at is not None:
+                self._remove(user_id)
+
+    def search(self, query, limit):
+        self._ensure_built()
+        needle = query.lower()
+        query_grams = trigrams(query)
+
+        with self._lock:
+            shared = defaultdict(int)
+            for gram in query_grams:
+                for user_id in self._postings.get(gram, ()):
+                    shared[user_id] += 1
+
+            # Substring matches must contain every inner trigram of the
+            # query, so intersect those postings instead of scanning.
+            inner = {needle[i:i + 3] for i in range(len(needle) - 2)}
+            if inner:
+                candidates = set.intersection(*(self._postings.get(gram, set()) for gram in inner))
+            else:
+                candidates = self._names.keys()
+            contains = {user_id for user_id in candidates if needle in self._names[user_id].lower()}
+
+            ranked = []
+            for user_id in contains | shared.keys():
+                common = shared.get(user_id, 0)
+                similarity = common / (len(query_grams) + len(trigrams(self._names[user_id])) - common)
+                if user_id in contains or similarity >= SIMILARITY_THRESHOLD:
+                    ranked.append((-similarity, user_id))
+
+        return [user_id for (similarity, user_id) in sorted(ranked)[:limit]]
+
+    def autocomplete(self, prefix, limit):
+        self._ensure_built()
+        prefix = prefix.lower()
+
+        with self._lock:
+            start = bisect.bisect_left(self._sorted, (prefix,))
+            matches = []
+            for name, user_id in self._sorted[start:start + limit]:
+                if not name.startswith(prefix):
+                    break
+                matches.append(user_id)
+        return matches
+
+
+def has_trigram_index():
+    """Does this database have the pg_trgm index on users.username?"""
+
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return False
+    return db.session.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+                              {"name": TRIGRAM_INDEX}).first() is not None
+
+
+def get_search():
+    """The search backend of the current app, picked on first use."""
+
+    backend = current_app.extensions.get('user_search')
+    if backend is None:
+        if has_trigram_index():
+            backend = TrigramSearch()
+        else:
+            backend = NgramIndex(ttl=current_app.config.get('SEARCH_INDEX_TTL', 300))
+        current_app.extensions['user_search'] = backend
+    return backend
+
+
+def reset_search():
+    """Forget the chosen backend (and any in-process index)."""
+
+    current_app.extensions.pop('user_search', None)
+
+
+@event.listens_for(User.__table__, "after_create")
+def create_trigram_index(target, connection, **kw):
+    """Create the search indexes along with the users table.
+
+    Skipped (with a warning) where pg_trgm isn't available; search then
+    falls back to NgramIndex.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    # Prefix autocomplete: lower(username) LIKE 'abc%' needs text_pattern_ops.
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {PREFIX_INDEX} "
+                            "ON users (lower(username) text_pattern_ops)"))
+
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} "
+                                "ON users USING gin (username gin_trgm_ops)"))
+        savepoint.commit()
+    except DBAPIError as error:
+        savepoint.rollback()
+        logger.warning("pg_trgm unavailable, using in-process search: %s", error.orig)
+
+
+def _indexed_backend():
+    try:
+        backend = current_app.extensions.get('user_search')
+    except RuntimeError:
+        return None
+    return backend if isinstance(backend, NgramIndex) else None
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def _index_user(mapper, connection, target):
+    backend = _indexed_backend()
+    if backend is not None:
+        backend.update(target.id, target.username)
+
+
+@event.listens_for(User, "after_delete")
+def _unindex_user(mapper, connection, target):
+    backend = _indexed_backend()
+    if backend is not None:
+        backend.remove(target.id)
@@ -1,24 +1,202 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+The CSVs are streamed in fixed-size chunks, one transaction per chunk, so
+memory stays flat however big they are. On Postgres each chunk goes in with
+COPY FROM STDIN; elsewhere (SQLite) with an executemany batch. Secondary
+indexes are dropped for the load and built once at the end. Afterwards the
+id sequences are moved past the loaded rows and the counters recomputed.
+
+run it like:
+
+    python seed.py                        # fresh load of generator/*.csv
+    python seed.py --data-dir /tmp/big --chunk-size 50000
+    python seed.py --resume               # carry on after an interruption
+
+--resume keeps the existing tables and skips as many CSV rows as each table
+already holds (chunks are committed whole, in file order). Ids carry on
+from the highest one loaded, so they still follow CSV row order.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from itertools import islice
+
+from sqlalchemy import func, select, text
 
-from csv import DictReader
 from app import app, db
-from models import User, Message, Follows
+from models import User, Message, Follows, Likes, reconcile_counters
+import search
+
+# Load order matters for the foreign keys.
+CSV_FILES = [
+    (User, 'users.csv'),
+    (Message, 'messages.csv'),
+    (Follows, 'follows.csv'),
+    (Likes, 'likes.csv'),
+]
+
+# Tables whose ids come from a sequence, in CSV row order.
+ID_SEQUENCES = [User, Message]
+
+# Indexes made outside the models (see search.py).
+EXTRA_INDEXES = [search.TRIGRAM_INDEX, search.PREFIX_INDEX]
+
+
+def read_chunks(path, chunk_size, skip=0):
+    """Yield (columns, rows) chunks of at most `chunk_size` rows from a CSV."""
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+        # step over rows an earlier run already loaded
+        next(islice(reader, skip, skip), None)
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            yield columns, rows
+
+
+def copy_chunk(connection, table, columns, rows):
+    """Load rows with Postgres COPY FROM STDIN."""
+
+    buffer = io.StringIO()
+    # Quote everything so empty strings stay empty strings (an unquoted
+    # empty field means NULL to COPY).
+    csv.writer(buffer, quoting=csv.QUOTE_ALL).writerows(rows)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(connection, table, columns, rows):
+    """Load rows with a plain executemany (SQLite and others)."""
+
+    if connection.dialect.paramstyle == 'qmark':
+        placeholders = ', '.join('?' for column in columns)
+    else:
+        placeholders = ', '.join('%s' for column in columns)
+
+    connection.exec_driver_sql(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+        [tuple(row) for row in rows])
+
+
+def load_csv(model, path, chunk_size, resume):
+    """Stream one CSV into `model`'s table, printing progress."""
+
+    table = model.__tablename__
+    skip = 0
+    if resume:
+        skip = db.session.scalar(select(func.count()).select_from(model))
+        db.session.commit()
+        # An interrupted COPY rolls back its rows but not the ids it drew,
+        # so the next row must get MAX(id) + 1 for later files to match up.
+        with db.engine.begin() as connection:
+            reset_sequence(connection, model)
 
-# db.drop_all()
-# db.create_all()
+    load_chunk = copy_chunk if db.engine.dialect.name == 'postgresql' else insert_chunk
+    loaded = 0
+    started = time.monotonic()
 
-# Create an application context
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+    for columns, rows in read_chunks(path, chunk_size, skip):
+        with db.engine.begin() as connection:
+            load_chunk(connection, table, columns, rows)
 
-    with open('generator/users.csv') as users:
-        db.session.bulk_insert_mappings(User, DictReader(users))
+        loaded += len(rows)
+        rate = loaded / max(time.monotonic() - started, 1e-6)
+        print(f"\r{table}: {skip + loaded:,} rows ({rate:,.0f} rows/s)", end='', file=sys.stderr)
 
-    with open('generator/messages.csv') as messages:
-        db.session.bulk_insert_mappings(Message, DictReader(messages))
+    print(f"\r{table}: {skip + loaded:,} rows, {loaded:,} loaded "
+          f"in {time.monotonic() - started:.1f}s", file=sys.stderr)
 
-    with open('generator/follows.csv') as follows:
-        db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+def drop_indexes(connection):
+    """Drop secondary indexes so the load doesn't maintain them row by row."""
+
+    for model, filename in CSV_FILES:
+        for index in model.__table__.indexes:
+            index.drop(connection, checkfirst=True)
+    for name in EXTRA_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def create_indexes(connection):
+    """Build the secondary indexes again, once, over the loaded data."""
+
+    for model, filename in CSV_FILES:
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+    search.create_trigram_index(User.__table__, connection)
+
+
+def reset_sequence(connection, model):
+    """Move a Postgres id sequence past the ids already in `model`'s table."""
+
+    if connection.dialect.name != 'postgresql' or model not in ID_SEQUENCES:
+        return
+    table = model.__tablename__
+    connection.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"))
+
+
+def reset_sequences(connection):
+    """Move Postgres id sequences past any ids that came in the CSVs."""
+
+    for model in ID_SEQUENCES:
+        reset_sequence(connection, model)
+
+
+def seed(data_dir='generator', chunk_size=10000, resume=False):
+    """Load every CSV in `data_dir` that exists."""
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+
+    with db.engine.begin() as connection:
+        drop_indexes(connection)
+
+    for model, filename in CSV_FILES:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            load_csv(model, path, chunk_size, resume)
+
+    print("Building indexes...", file=sys.stderr)
+    with db.engine.begin() as connection:
+        create_indexes(connection)
+        reset_sequences(connection)
+
+    # the loader skips the counter upkeep, so compute them in one go
+    print("Reconciling counters...", file=sys.stderr)
+    reconcile_counters()
     db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("ANALYZE"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the Warbler database from CSV files.")
+    parser.add_argument('--data-dir', default='generator',
+                        help="directory holding users.csv, messages.csv, follows.csv (and likes.csv)")
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help="rows per COPY/executemany batch (and per transaction)")
+    parser.add_argument('--resume', action='store_true',
+                        help="keep existing rows and continue where a previous load stopped")
+    args = parser.parse_args()
+
+    # Create an application context
+    with app.app_context():
+        seed(args.data_dir, args.chunk_size, args.resume)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+# python -m unittest -v test_jobs.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event, select
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Job, Likes, Message, User
+import fragment_cache
+import jobs
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@jobs.handler('test_record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.handler('test_fail')
+def fail():
+    raise ValueError("nope")
+
+
+class SharedStore(timeline_cache.InMemoryTimelineStore):
+    """Stands in for a store every process sees (e.g. Redis)."""
+
+    shared = True
+
+
+class JobQueueTestCase(TestCase):
+    """Enqueueing, claiming, running and retrying jobs."""
+
+    def setUp(self):
+        # queue jobs instead of running them in the request
+        self.saved_testing = app.config['TESTING']
+        app.config['TESTING'] = False
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
+            user = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            self.user_id = user.id
+
+        calls.clear()
+        self.worker = jobs.Worker(app, threads=2, poll_interval=0.01)
+
+    def statuses(self):
+        with app.app_context():
+            return [(job.name, job.status, job.attempts) for job in
+                    db.session.scalars(select(Job).order_by(Job.id))]
+
+    def test_enqueue_and_run(self):
+        """Are committed jobs run once, and rolled back ones never?"""
+
+        with app.app_context():
+            jobs.enqueue('test_record', value=1)
+            jobs.enqueue('test_record', idempotency_key="once", value=2)
+            jobs.enqueue('test_record', idempotency_key="once", value=3)
+            db.session.commit()
+
+            jobs.enqueue('test_record', value=4)
+            db.session.rollback()
+
+        self.worker.run(once=True)
+
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual(self.statuses(), [('test_record', 'done', 1)] * 2)
+
+    def test_retry_then_fail(self):
+        """Is a failing job retried with backoff, then marked failed?"""
+
+        with app.app_context():
+            jobs.enqueue('test_fail', max_attempts=2)
+            db.session.commit()
+
+        with self.assertLogs("jobs", "ERROR"):
+            self.worker.run(once=True)
+
+        with app.app_context():
+            job = db.session.scalars(select(Job)).one()
+            self.assertEqual((job.status, job.attempts), ('queued', 1))
+            self.assertGreater(job.run_at, datetime.utcnow())
+            self.assertIn("ValueError: nope", job.last_error)
+
+            job.run_at = datetime.utcnow()
+            db.session.commit()
+
+        with self.assertLogs("jobs", "ERROR"):
+            self.worker.run(once=True)
+        self.assertEqual(self.statuses(), [('test_fail', 'failed', 2)])
+
+    def test_skip_locked(self):
+        """Does a claim skip jobs another worker has locked?"""
+
+        with app.app_context():
+            for value in range(2):
+                jobs.enqueue('test_record', value=value)
+            db.session.commit()
+            first, second = db.session.scalars(select(Job.id).order_by(Job.id)).all()
+
+            with db.engine.connect() as other:
+                other.execute(select(Job).where(Job.id == first).with_for_update())
+                self.assertEqual(jobs.claim(10), [second])
+
+    def test_stale_job_reclaimed(self):
+        """Is a job whose worker died picked up again?"""
+
+        with app.app_context():
+            jobs.enqueue('test_record', value=1)
+            db.session.commit()
+            self.assertEqual(len(jobs.claim(10)), 1)
+            self.assertEqual(jobs.claim(10), [])
+
+            job = db.session.scalars(select(Job)).one()
+            job.locked_at = datetime.utcnow() - timedelta(seconds=600)
+            db.session.commit()
+
+        self.worker.run(once=True)
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.statuses(), [('test_record', 'done', 2)])
+
+    def test_timeline_jobs_need_shared_store(self):
+        """Is timeline work only queued when the worker's updates are seen?"""
+
+        with app.app_context():
+            follower = User.signup("follower", "follower@test.com", "password", None)
+            db.session.commit()
+            follower_id = follower.id
+            Follows.start(follower_id, self.user_id)
+            db.session.commit()
+            timeline_cache.rebuild(follower_id)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        # in-process store: the route fans out itself
+        client.post("/messages/new", data={"text": "Hello"})
+        self.assertEqual(self.statuses(), [])
+        with app.app_context():
+            message_id = db.session.scalar(select(Message.id))
+            self.assertEqual(timeline_cache.get_store().get(follower_id, 10), [message_id])
+
+        saved = app.extensions['timelines']
+        app.extensions['timelines'] = SharedStore()
+        try:
+            client.post("/messages/new", data={"text": "Hello again"})
+            client.post(f"/users/follow/{follower_id}")
+        finally:
+            app.extensions['timelines'] = saved
+
+        self.assertEqual(self.statuses(), [('fan_out', 'queued', 0),
+                                           ('rebuild_timeline', 'queued', 0)])
+
+    def test_delete_user_job(self):
+        """Is a deleted account hidden at once, then purged a batch per transaction?"""
+
+        with app.app_context():
+            for number in range(3):
+                Message.post(self.user_id, f"warble {number}")
+            db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        client.post("/users/delete")
+
+        self.assertEqual(self.statuses(), [('delete_user', 'queued', 0)])
+        self.assertEqual(client.get(f"/users/{self.user_id}").status_code, 404)
+        with app.app_context():
+            self.assertFalse(User.authenticate("testuser", "password"))
+
+        saved = app.config['PURGE_BATCH_SIZE'], app.config['PURGE_BATCHES_PER_JOB']
+        app.config['PURGE_BATCH_SIZE'], app.config['PURGE_BATCHES_PER_JOB'] = 1, 2
+        try:
+            self.worker.run(once=True)
+        finally:
+            app.config['PURGE_BATCH_SIZE'], app.config['PURGE_BATCHES_PER_JOB'] = saved
+
+        # three messages, two per job, then the user row
+        self.assertEqual(self.statuses(), [('delete_user', 'done', 1)] * 2)
+        with app.app_context():
+            self.assertIsNone(db.session.get(User, self.user_id))
+
+    def test_deleted_author_hidden(self):
+        """Are a deleted account's messages gone before they're purged?"""
+
+        with app.app_context():
+            follower = User.signup("follower", "follower@test.com", "password", None)
+            db.session.commit()
+            follower_id = follower.id
+            Follows.start(follower_id, self.user_id)
+            message_id = Message.post(self.user_id, "Goodbye").id
+            db.session.commit()
+            Likes.toggle(follower_id, message_id)
+            db.session.commit()
+            self.assertEqual(timeline_cache.rebuild(follower_id), [message_id])
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        client.post("/users/delete")
+        self.assertEqual(self.statuses(), [('delete_user', 'queued', 0)])
+
+        with app.app_context():
+            self.assertIsNone(timeline_cache.get_store().get(follower_id, 10))
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = follower_id
+        self.assertNotIn("Goodbye", client.get("/").get_data(as_text=True))
+        self.assertNotIn("Goodbye",
+                         client.get(f"/users/{follower_id}/liked_warbles").get_data(as_text=True))
+        self.assertEqual(client.get(f"/messages/{message_id}").status_code, 404)
+        self.assertEqual(client.post(f"/messages/{message_id}/like").status_code, 404)
+        self.assertEqual(client.post("/likes/toggle", json={"message_ids": [message_id]})
+                         .status_code, 404)
+
+    def test_deleted_author_retracted_by_job(self):
+        """With a shared store, are followers' timelines retracted by the job?"""
+
+        saved = app.extensions['timelines']
+        app.extensions['timelines'] = SharedStore()
+        try:
+            with app.app_context():
+                follower_ids = []
+                for number in range(3):
+                    follower = User.signup(f"follower{number}", f"follower{number}@test.com",
+                                           "password", None)
+                    db.session.flush()
+                    Follows.start(follower.id, self.user_id)
+                    follower_ids.append(follower.id)
+                Message.post(self.user_id, "Goodbye")
+                db.session.commit()
+                for follower_id in follower_ids:
+                    timeline_cache.rebuild(follower_id)
+
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            with app.app_context():
+                engine = db.engine
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                client.post("/users/delete")
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+
+            self.assertFalse([statement for statement in statements
+                              if "FROM follows" in statement], statements)
+            with app.app_context():
+                store = timeline_cache.get_store()
+                self.assertTrue(all(store.get(id, 10) for id in follower_ids))
+
+            self.worker.run(once=True)
+            with app.app_context():
+                self.assertTrue(all(store.get(id, 10) is None for id in follower_ids))
+        finally:
+            app.extensions['timelines'] = saved
+
+    def test_prune(self):
+        """Are old finished jobs deleted?"""
+
+        with app.app_context():
+            jobs.enqueue('test_record', value=1)
+            db.session.commit()
+        self.worker.run(once=True)
+
+        with app.app_context():
+            self.assertEqual(jobs.prune(60), 0)
+            self.assertEqual(jobs.prune(-1), 1)
+
+    def tearDown(self):
+        app.config['TESTING'] = self.saved_testing
+        with app.app_context():
+            db.session.rollback()
@@ -8,7 +8,8 @@
 
 import os
 from unittest import TestCase
-from models import db, User, Message, Follows
+from sqlalchemy import exc
+from models import db, User, Message, Follows, Likes, Timeline
 from app import app
 
 # Set up test database
@@ -95,6 +96,50 @@ class MessageModelTestCase(TestCase):
             self.assertEqual(len(messages), 2)
             self.assertEqual(messages[1].text, 'new message')    
             
+    def test_home_timeline(self):
+        """Does Timeline.home fetch followed messages with the viewer's likes?"""
+
+        with app.app_context():
+            u1 = User.query.filter_by(username='user1').one()
+            u2 = User.query.filter_by(username='user2').one()
+            m2 = Message.query.filter_by(text='text message 2').one()
+
+            messages, liked_ids, next_cursor = Timeline.home(u1.id).page()
+            self.assertEqual([m.text for m in messages], ['text message 1'])
+
+            db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+            db.session.add(Likes(user_id=u1.id, message_id=m2.id))
+            db.session.commit()
+
+            messages, liked_ids, next_cursor = Timeline.home(u1.id).page()
+            self.assertEqual([m.text for m in messages], ['text message 2', 'text message 1'])
+            self.assertEqual(messages[0].user.username, 'user2')
+            self.assertEqual(liked_ids, {m2.id})
+            self.assertIsNone(next_cursor)
+
+            messages, liked_ids, next_cursor = Timeline.home(u1.id).page(per_page=1)
+            self.assertEqual(next_cursor, messages[0].cursor)
+
+    def test_like_toggle(self):
+        """Does Likes.toggle flip a single row and keep the counts right?"""
+
+        with app.app_context():
+            u1 = User.query.filter_by(username='user1').one()
+            m2 = Message.query.filter_by(text='text message 2').one()
+
+            self.assertEqual(Likes.toggle(u1.id, m2.id), (True, 1))
+            self.assertEqual(Likes.toggle(u1.id, m2.id), (False, 0))
+            self.assertEqual(Likes.toggle(u1.id, m2.id), (True, 1))
+            db.session.commit()
+
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(User.query.get(u1.id).likes_count, 1)
+
+            # a user can only like a message once
+            with self.assertRaises(exc.IntegrityError):
+                db.session.add(Likes(user_id=u1.id, message_id=m2.id))
+                db.session.commit()
+
     def tearDown(self):
         """Remove test data and database tables"""
 
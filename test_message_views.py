@@ -9,7 +9,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +22,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragment_cache
+import timeline_cache
+import user_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,6 +37,9 @@ with app.app_context():
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs (timeline fan-out) inside the request
+app.config['TESTING'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -57,6 +63,10 @@ class MessageViewTestCase(TestCase):
             self.assertIsNotNone(user)
             self.assertEqual(user.username, "testuser")
 
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
 
     def test_add_message(self):
         """Can use add a message?"""
@@ -79,6 +89,7 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
             self.assertEqual(msg.user_id, self.testuser.id)
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
 
     def test_show_message(self):
         """Can we show a message?"""
@@ -101,6 +112,100 @@ class MessageViewTestCase(TestCase):
                 self.assertEqual(resp.status_code, 200)
                 self.assertIn(m.text, html)
 
+    def test_show_message_conditional(self):
+        """Does a message page answer 304 until its author changes?"""
+
+        with app.app_context():
+            m = Message(id=1234, text="Test message", user_id=self.testuser.id)
+            db.session.add(m)
+            db.session.commit()
+
+            with self.client as c:
+                resp = c.get("/messages/1234")
+                etag = resp.headers["ETag"]
+                self.assertIn("public", resp.headers["Cache-Control"])
+                self.assertIsNotNone(resp.last_modified)
+
+                resp = c.get("/messages/1234", headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 304)
+
+                user = db.session.get(User, self.testuser.id)
+                user.username = "renamed"
+                db.session.commit()
+
+                resp = c.get("/messages/1234", headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("@renamed", resp.get_data(as_text=True))
+
+    def test_message_items_cached(self):
+        """Are message items served from the cache until the author edits their profile?"""
+
+        with app.app_context():
+            db.session.add(Message(id=1234, text="Test message", user_id=self.testuser.id))
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                self.assertIn("@testuser<", c.get("/").get_data(as_text=True))
+
+                # a change behind the app's back isn't seen: the item is cached
+                user = db.session.get(User, self.testuser.id)
+                user.username = "renamed"
+                db.session.commit()
+                self.assertIn("@testuser<", c.get(f"/users/{self.testuser.id}").get_data(as_text=True))
+
+                c.post(f"/users/{self.testuser.id}/edit",
+                       data={"username": "edited", "email": "test@test.com", "password": "testuser"})
+                self.assertIn("@edited<", c.get("/").get_data(as_text=True))
+
+                c.post("/messages/1234/delete")
+                self.assertNotIn("Test message", c.get("/").get_data(as_text=True))
+
+    def test_message_items_stale_author(self):
+        """Does an author row from before an edit (a lagging replica) only
+        ever get the item rendered before the edit?"""
+
+        with app.app_context():
+            db.session.add(Message(id=1234, text="Test message", user_id=self.testuser.id))
+            db.session.commit()
+
+            with app.test_request_context():
+                message = db.session.get(Message, 1234)
+                fragment_cache.message_items([message])
+                before = message.user.profile_updated_at
+                db.session.expunge_all()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                c.post(f"/users/{self.testuser.id}/edit",
+                       data={"username": "edited", "email": "test@test.com", "password": "testuser"})
+
+            with app.test_request_context():
+                message = db.session.get(Message, 1234)
+                self.assertGreater(message.user.profile_updated_at, before)
+                self.assertIn("@edited<", fragment_cache.message_items([message])[1234])
+
+                # what a replica that hasn't replayed the edit yet would return
+                message.user.username = "testuser"
+                message.user.profile_updated_at = before
+                self.assertIn("@testuser<", fragment_cache.message_items([message])[1234])
+                db.session.rollback()
+
+    def test_message_items_expire(self):
+        """Do in-process items expire, so other workers' stale ones go too?"""
+
+        store = fragment_cache.InMemoryFragmentStore(ttl=60)
+        store.set_many({"message:1:v": "<p>item</p>"})
+        self.assertEqual(store.get_many(["message:1:v", "message:2:v"]),
+                         {"message:1:v": "<p>item</p>"})
+
+        store.ttl = -1
+        store.set_many({"message:1:v": "<p>item</p>"})
+        self.assertEqual(store.get_many(["message:1:v"]), {})
+
     def test_delete_message(self):
         """Can we delete a message?"""
 
@@ -125,6 +230,103 @@ class MessageViewTestCase(TestCase):
                 msg = Message.query.get(m.id)
                 self.assertIsNone(msg)
              
+    def test_add_message_fans_out(self):
+        """Does a new message land on the followers' cached timelines?"""
+
+        with app.app_context():
+            follower = User.signup(username="follower",
+                                   email="follower@test.com",
+                                   password="follower",
+                                   image_url=None)
+            db.session.commit()
+            db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                                   user_following_id=follower.id))
+            db.session.commit()
+            follower_id = follower.id
+
+            # Warm the follower's timeline before the message is posted.
+            self.assertEqual(timeline_cache.rebuild(follower_id), [])
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/new", data={"text": "Hello followers"})
+
+            msg = Message.query.one()
+            store = timeline_cache.get_store()
+            self.assertEqual(store.get(follower_id, 100), [msg.id])
+            self.assertEqual(store.get(self.testuser.id, 100), None)
+
+    def test_delete_message_retracts(self):
+        """Is a deleted message removed from cached timelines?"""
+
+        with app.app_context():
+            m = Message(id=1234, text="Test message", user_id=self.testuser.id)
+            db.session.add(m)
+            db.session.commit()
+
+            self.assertEqual(timeline_cache.rebuild(self.testuser.id), [1234])
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.post("/messages/1234/delete")
+
+            self.assertEqual(timeline_cache.get_store().get(self.testuser.id, 100), [])
+
+    def test_toggle_like(self):
+        """Does the JSON endpoint like and unlike a message?"""
+
+        with app.app_context():
+            m = Message(id=1234, text="Test message", user_id=self.testuser.id)
+            db.session.add(m)
+            db.session.commit()
+
+            with self.client as c:
+                resp = c.post("/messages/1234/like")
+                self.assertEqual(resp.status_code, 401)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.post("/messages/1234/like")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json(), {"message_id": 1234, "liked": True, "likes": 1})
+
+                resp = c.post("/messages/1234/like")
+                self.assertEqual(resp.get_json(), {"message_id": 1234, "liked": False, "likes": 0})
+
+                resp = c.post("/messages/4321/like")
+                self.assertEqual(resp.status_code, 404)
+
+    def test_toggle_likes_bulk(self):
+        """Are queued like toggles applied together?"""
+
+        with app.app_context():
+            db.session.add_all([Message(id=1234, text="First", user_id=self.testuser.id),
+                                Message(id=1235, text="Second", user_id=self.testuser.id)])
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.post("/likes/toggle", json={"message_ids": [1234, 1235, 1234]})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json(), {"likes": [
+                    {"message_id": 1234, "liked": False, "likes": 0},
+                    {"message_id": 1235, "liked": True, "likes": 1},
+                ]})
+
+                resp = c.post("/likes/toggle", json={"message_ids": [1235, 999]})
+                self.assertEqual(resp.status_code, 404)
+                self.assertEqual(Message.query.get(1235).likes_count, 1)
+
+                resp = c.post("/likes/toggle", json={"message_ids": "1235"})
+                self.assertEqual(resp.status_code, 400)
+
     def tearDown(self): 
         with app.app_context():
             db.session.rollback()
@@ -0,0 +1,153 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+# python -m unittest -v test_metrics.py
+
+import os
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User, engine_options, _limit_statements
+from metrics import TimedQueuePool
+import fragment_cache
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(TestCase):
+    """Request, template, pool and bcrypt metrics."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
+            user = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def test_request_and_template_metrics(self):
+        """Are requests counted per endpoint and status, with their templates?"""
+
+        requests = ('warbler_request_duration_seconds_count',
+                    dict(endpoint='homepage', method='GET', status='200'))
+        renders = ('warbler_template_render_seconds_count', dict(template='home.html'))
+        checkouts = ('warbler_db_pool_checkout_seconds_count', {})
+        before = [sample(name, **labels) for name, labels in (requests, renders, checkouts)]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get("/")
+        self.assertEqual(resp.status_code, 200)
+
+        after = [sample(name, **labels) for name, labels in (requests, renders, checkouts)]
+        self.assertEqual(after[0], before[0] + 1)
+        self.assertEqual(after[1], before[1] + 1)
+        self.assertGreater(after[2], before[2])
+        self.assertEqual(sample('warbler_requests_in_flight'), 0)
+
+    def test_bcrypt_metrics(self):
+        """Are password checks timed?"""
+
+        before = sample('warbler_bcrypt_seconds_count', operation='check')
+        with app.app_context():
+            User.authenticate("testuser", "password")
+        self.assertEqual(sample('warbler_bcrypt_seconds_count', operation='check'), before + 1)
+
+    def test_metrics_endpoint(self):
+        """Does /metrics serve the Prometheus text format?"""
+
+        self.client.get("/login")
+        resp = self.client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("text/plain", resp.content_type)
+        text = resp.get_data(as_text=True)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="login"', text)
+        self.assertIn("warbler_requests_in_flight", text)
+        self.assertIn('warbler_bcrypt_seconds_count{operation="hash"}', text)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.rollback()
+
+
+class PoolTestCase(TestCase):
+    """Engine options, checkout waits and statement timeouts."""
+
+    def test_engine_options(self):
+        """Are the DB_* settings turned into engine options?"""
+
+        config = dict(SQLALCHEMY_DATABASE_URI="postgresql+psycopg:///warblerdb",
+                      SQLALCHEMY_ENGINE_OPTIONS={'poolclass': TimedQueuePool},
+                      DB_POOL_SIZE=3, DB_MAX_OVERFLOW=2, DB_POOL_TIMEOUT=5,
+                      DB_POOL_RECYCLE=600, DB_POOL_PRE_PING=True, DB_PGBOUNCER=False)
+
+        options = engine_options(config)
+        self.assertEqual(options['poolclass'], TimedQueuePool)
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_timeout']),
+                         (3, 2, 5))
+        self.assertNotIn('connect_args', options)
+
+        config['DB_PGBOUNCER'] = True
+        self.assertEqual(engine_options(config)['connect_args'], {'prepare_threshold': None})
+
+        # psycopg2 never prepares statements server-side
+        config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///warblerdb"
+        self.assertNotIn('connect_args', engine_options(config))
+
+    def test_checkout_wait_reported(self):
+        """Does a response report its pool wait, and are slow waits logged?"""
+
+        saved = TimedQueuePool.slow_checkout
+        TimedQueuePool.slow_checkout = -1
+        try:
+            with self.assertLogs("metrics", "WARNING") as logs:
+                resp = app.test_client().get("/users")
+        finally:
+            TimedQueuePool.slow_checkout = saved
+
+        self.assertIn("Waited", logs.output[0])
+        self.assertTrue(any(timing.startswith("pool;dur=")
+                            for timing in resp.headers.getlist("Server-Timing")))
+
+    def test_statement_timeout(self):
+        """Are a request's statements cancelled after DB_STATEMENT_TIMEOUT_MS?"""
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'begin', _limit_statements)
+        saved = app.config['DB_STATEMENT_TIMEOUT_MS']
+        app.config['DB_STATEMENT_TIMEOUT_MS'] = 50
+        try:
+            with app.test_request_context():
+                with self.assertRaises(OperationalError):
+                    db.session.execute(text("SELECT pg_sleep(1)"))
+                db.session.rollback()
+
+            # outside a request there's no limit
+            with app.app_context():
+                db.session.execute(text("SELECT pg_sleep(0.1)"))
+                db.session.rollback()
+        finally:
+            app.config['DB_STATEMENT_TIMEOUT_MS'] = saved
+            event.remove(engine, 'begin', _limit_statements)
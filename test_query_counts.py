@@ -0,0 +1,147 @@
+"""SQL statement budget tests.
+
+Each message list route must issue a fixed number of statements no matter
+how many messages or authors are on the page, so an N+1 regression (e.g. a
+template touching a lazily loaded relationship per message) fails here.
+"""
+
+# run these tests like:
+#
+# python -m unittest -v test_query_counts.py
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+import fragment_cache
+import timeline_cache
+import user_cache
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///warblerdb_test'
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 10
+
+# Statements a route may run for a full page, whichever author loader is used.
+MAX_STATEMENTS = {
+    '/': 4,
+    '/users/{author_id}': 5,
+    '/users/{user_id}/liked_warbles': 3,
+    # projected user cards: touching an unloaded column would lazy-load per card
+    '/users': 3,
+    # one page of follows, slim cards, one follow-state lookup for the page
+    '/users/{user_id}/following': 4,
+    '/users/{author_id}/followers': 4,
+}
+
+
+@contextmanager
+def count_statements():
+    """Collect every SQL statement run on the engine inside the block."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+class QueryCountTestCase(TestCase):
+    """Statement budgets for message list routes."""
+
+    def setUp(self):
+        """Create a reader following many authors, each with messages."""
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
+            self.client = app.test_client()
+
+            reader = User(email="reader@test.com", username="reader", password="HASHED_PASSWORD")
+            authors = [User(email=f"author{i}@test.com", username=f"author{i}", password="HASHED_PASSWORD")
+                       for i in range(NUM_AUTHORS)]
+            db.session.add_all([reader] + authors)
+            db.session.commit()
+
+            start = datetime(2023, 1, 1)
+            for i, author in enumerate(authors):
+                db.session.add(Follows(user_being_followed_id=author.id, user_following_id=reader.id))
+                for j in range(3):
+                    db.session.add(Message(text=f"warble {i}-{j}", user_id=author.id,
+                                           timestamp=start + timedelta(minutes=10 * i + j)))
+            db.session.commit()
+
+            for msg in Message.query.all():
+                db.session.add(Likes(user_id=reader.id, message_id=msg.id))
+            db.session.commit()
+
+            self.user_id = reader.id
+            self.author_id = authors[0].id
+
+    def assert_statement_budget(self, author_loader):
+        app.config['TIMELINE_AUTHOR_LOADER'] = author_loader
+
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                for route, budget in MAX_STATEMENTS.items():
+                    url = route.format(user_id=self.user_id, author_id=self.author_id)
+                    with self.subTest(route=route, author_loader=author_loader):
+                        # start every request from an empty identity map
+                        db.session.expunge_all()
+                        with count_statements() as statements:
+                            resp = c.get(url)
+
+                        self.assertEqual(resp.status_code, 200)
+                        self.assertLessEqual(len(statements), budget, "\n\n".join(statements))
+
+    def test_joined_loader(self):
+        """Do message lists stay within budget with joined author loading?"""
+
+        self.assert_statement_budget("joined")
+
+    def test_selectin_loader(self):
+        """Do message lists stay within budget with selectin author loading?"""
+
+        self.assert_statement_budget("selectin")
+
+    def test_warm_home(self):
+        """With the current user and timeline cached, is home one statement?"""
+
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.get("/")
+                db.session.expunge_all()
+                with count_statements() as statements:
+                    resp = c.get("/")
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(len(statements), 1, "\n\n".join(statements))
+
+    def tearDown(self):
+        app.config['TIMELINE_AUTHOR_LOADER'] = 'joined'
+
+        with app.app_context():
+            db.session.rollback()
+            db.drop_all()
+            db.create_all()
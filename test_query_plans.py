@@ -0,0 +1,165 @@
+"""Query plan tests.
+
+Every statement a route runs is replayed under EXPLAIN with sequential
+scans and sorts disabled. Postgres then only uses either one if no index
+can do the job, so a Seq Scan or Sort node in the plan means an index is
+missing (or a query stopped matching one).
+"""
+
+# run these tests like:
+#
+# python -m unittest -v test_query_plans.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+import fragment_cache
+import search
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+NUM_USERS = 30
+MESSAGES_PER_USER = 10
+
+# Plan nodes that mean a table was read in full or rows were sorted.
+FORBIDDEN_NODES = {'Seq Scan', 'Sort', 'Incremental Sort'}
+
+
+def plan_nodes(plan):
+    """Every node of a JSON EXPLAIN plan."""
+
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class QueryPlanTestCase(TestCase):
+    """No route's statements need a sequential scan or a sort."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+            search.reset_search()
+
+            users = [User(email=f"user{n}@test.com", username=f"user{n}", password="HASHED")
+                     for n in range(NUM_USERS)]
+            db.session.add_all(users)
+            db.session.flush()
+            for n, user in enumerate(users):
+                for other in users[n + 1:n + 6]:
+                    Follows.start(user.id, other.id)
+                    Follows.start(other.id, user.id)
+                for number in range(MESSAGES_PER_USER):
+                    Message.post(user.id, f"warble {number}")
+            db.session.flush()
+            for user in users[:10]:
+                for msg in Message.query.filter(Message.user_id == users[-1].id):
+                    Likes.toggle(user.id, msg.id)
+            db.session.commit()
+            db.session.execute(db.text("ANALYZE"))
+            db.session.commit()
+
+            self.user_id = users[0].id
+            self.other_id = users[1].id
+            self.stranger_id = users[-1].id
+            self.message_id = Message.query.filter_by(user_id=self.stranger_id).first().id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def statements(self, method, url, **kwargs):
+        """[(statement, parameters)] a request runs."""
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().split()[0].upper() in (
+                    'SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+                statements.append((statement, parameters))
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            resp = self.client.open(url, method=method, **kwargs)
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+
+        self.assertLess(resp.status_code, 400, url)
+        return statements
+
+    def assertIndexedPlans(self, method, url, **kwargs):
+        statements = self.statements(method, url, **kwargs)
+        self.assertTrue(statements, url)
+
+        with app.app_context():
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql("SET enable_seqscan = off")
+                connection.exec_driver_sql("SET enable_sort = off")
+                for statement, parameters in statements:
+                    [[plans]] = connection.exec_driver_sql(
+                        "EXPLAIN (FORMAT JSON) " + statement, parameters).all()
+                    nodes = {node['Node Type'] for node in plan_nodes(plans[0]['Plan'])}
+                    bad = nodes & FORBIDDEN_NODES
+                    self.assertFalse(bad, f"{method} {url} needs {', '.join(sorted(bad))}:\n"
+                                          f"{statement}")
+                connection.rollback()
+
+    def test_message_lists(self):
+        """Home timeline, profile and liked pages, first and later pages."""
+
+        # the home page twice: building the cold timeline, then reading it
+        for url in ("/", "/", f"/users/{self.stranger_id}",
+                    f"/users/{self.user_id}/liked_warbles"):
+            with self.subTest(url=url):
+                self.assertIndexedPlans('GET', url)
+
+        # keyset pages
+        cursor = "2100-01-01T00:00:00,1000000"
+        for url in (f"/?before={cursor}", f"/users/{self.stranger_id}?before={cursor}",
+                    f"/users/{self.user_id}/liked_warbles?before={cursor}"):
+            with self.subTest(url=url):
+                self.assertIndexedPlans('GET', url)
+
+    def test_user_lists(self):
+        """Directory, following and followers pages."""
+
+        for url in ("/users", f"/users?after={self.user_id}",
+                    f"/users/{self.user_id}/following", f"/users/{self.user_id}/followers"):
+            with self.subTest(url=url):
+                self.assertIndexedPlans('GET', url)
+
+    def test_message_page(self):
+        self.assertIndexedPlans('GET', f"/messages/{self.message_id}")
+
+    def test_writes(self):
+        """Posting, liking, following and unfollowing."""
+
+        self.assertIndexedPlans('POST', "/messages/new", data={"text": "Hello"})
+        self.assertIndexedPlans('POST', f"/messages/{self.message_id}/like")
+        self.assertIndexedPlans('POST', f"/users/stop-following/{self.other_id}")
+        self.assertIndexedPlans('POST', f"/users/follow/{self.other_id}")
+
+    def test_delete_message(self):
+        self.statements('GET', "/")  # warm the timeline
+        with app.app_context():
+            message_id = Message.query.filter_by(user_id=self.user_id).first().id
+        self.assertIndexedPlans('POST', f"/messages/{message_id}/delete")
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.rollback()
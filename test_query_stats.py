@@ -0,0 +1,112 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+# python -m unittest -v test_query_stats.py
+
+import os
+import re
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User
+from query_stats import fingerprint, get_query_stats, RequestQueries
+import fragment_cache
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FingerprintTestCase(TestCase):
+    """Statements that differ only in parameters share a fingerprint."""
+
+    def test_parameters_and_literals(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users\n  WHERE id = %(id_1)s AND bio = 'x''y' LIMIT 20"),
+            "SELECT * FROM users WHERE id = ? AND bio = ? LIMIT ?")
+
+    def test_lists_collapse(self):
+        self.assertEqual(fingerprint("SELECT 1 FROM likes WHERE message_id IN (%(p_1)s, %(p_2)s)"),
+                         fingerprint("SELECT 1 FROM likes WHERE message_id IN (?, ?, ?)"))
+
+    def test_identifiers_kept(self):
+        self.assertEqual(fingerprint("SELECT count(*) AS count_1 FROM anon_2"),
+                         "SELECT count(*) AS count_1 FROM anon_2")
+
+
+class QueryStatsTestCase(TestCase):
+    """Per-request counts, logging and per-endpoint aggregates."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+            get_query_stats().clear()
+
+            user = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def test_server_timing_and_aggregates(self):
+        """Does a request report its statements and land in the aggregates?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get("/")
+            resp = c.get(f"/users/{self.user_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(any(re.match(r'^db;dur=[\d.]+;desc="\d+ statements"$', timing)
+                                for timing in resp.headers.getlist("Server-Timing")))
+
+            with app.app_context():
+                snapshot = get_query_stats().snapshot()
+            self.assertEqual(snapshot["homepage"]["requests"], 1)
+            self.assertEqual(snapshot["users_show"]["requests"], 1)
+            self.assertGreater(snapshot["users_show"]["statements_mean"], 0)
+            self.assertEqual(snapshot["users_show"]["repeated_statement_requests"], 0)
+
+    def test_repeated_statements_logged(self):
+        """Is a statement repeated with different parameters flagged as N+1?"""
+
+        queries = RequestQueries()
+        for user_id in range(6):
+            queries.add(f"SELECT * FROM users WHERE id = {user_id}", 0.001)
+        queries.add("SELECT * FROM messages", 0.001)
+
+        with app.app_context():
+            stats = get_query_stats()
+            with self.assertLogs("query_stats", "WARNING") as logs:
+                stats.record("users_show", queries, request_ms=10)
+
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn("6 x SELECT * FROM users WHERE id = ?", logs.output[0])
+            self.assertEqual(stats.snapshot()["users_show"]["repeated_statement_requests"], 1)
+
+    def test_slow_request_logged(self):
+        """Are requests over the threshold logged?"""
+
+        queries = RequestQueries()
+        queries.add("SELECT 1", 0.2)
+
+        with app.app_context():
+            stats = get_query_stats()
+            with self.assertLogs("query_stats", "WARNING") as logs:
+                stats.record("homepage", queries, request_ms=stats.slow_ms + 1)
+
+        self.assertIn("Slow request homepage", logs.output[0])
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.rollback()
+            get_query_stats().clear()
@@ -0,0 +1,240 @@
+"""Redis timeline and fragment store tests, against an in-memory stand-in."""
+
+# run these tests like:
+#
+# python -m unittest -v test_redis_stores.py
+
+import os
+import threading
+from unittest import TestCase
+
+from flask import Flask
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+from redis_client import connect_redis
+import fragment_cache
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+
+def _bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class FakeRedis:
+    """The few Redis commands the stores use, answering like redis-py (bytes)."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.transactions = []
+        self.lock = threading.RLock()
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def delete(self, key):
+        with self.lock:
+            self.expiries.pop(key, None)
+            return int(self.data.pop(key, None) is not None)
+
+    def lrange(self, key, start, stop):
+        values = self.data.get(key, [])
+        return values[start:None if stop == -1 else stop + 1]
+
+    def lpushx(self, key, value):
+        with self.lock:
+            if key not in self.data:
+                return 0
+            self.data[key].insert(0, _bytes(value))
+            return len(self.data[key])
+
+    def rpush(self, key, *values):
+        with self.lock:
+            self.data.setdefault(key, []).extend(_bytes(value) for value in values)
+            return len(self.data[key])
+
+    def ltrim(self, key, start, stop):
+        with self.lock:
+            if key in self.data:
+                self.data[key] = self.lrange(key, start, stop)
+
+    def lrem(self, key, count, value):
+        with self.lock:
+            values = self.data.get(key, [])
+            kept = [item for item in values if item != _bytes(value)]
+            if kept:
+                self.data[key] = kept
+            else:
+                self.data.pop(key, None)
+            return len(values) - len(kept)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.data[key] = _bytes(value)
+            self.expiries[key] = ex
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self, transaction)
+
+
+class FakePipeline:
+    """Queues commands and runs them together on execute(), like MULTI/EXEC."""
+
+    def __init__(self, client, transaction):
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.client.lock:
+            if self.transaction:
+                self.client.transactions.append([name for name, args, kwargs in self.commands])
+            return [getattr(self.client, name)(*args, **kwargs)
+                    for name, args, kwargs in self.commands]
+
+
+class RedisTimelineStoreTestCase(TestCase):
+    """RedisTimelineStore on its own."""
+
+    def setUp(self):
+        self.client = FakeRedis()
+        self.store = timeline_cache.RedisTimelineStore(self.client, max_length=3)
+
+    def test_cold_timeline(self):
+        """Is a timeline that was never built cold, and pushes to it ignored?"""
+
+        self.assertIsNone(self.store.get(1, 10))
+        self.store.push([1], 5)
+        self.assertIsNone(self.store.get(1, 10))
+
+    def test_replace_push_remove_invalidate(self):
+        self.store.replace(1, [9, 8, 7, 6])
+        self.assertEqual(self.store.get(1, 10), [9, 8, 7])
+        self.assertEqual(self.store.get(1, 2), [9, 8])
+
+        self.store.push([1, 2], 10)
+        self.assertEqual(self.store.get(1, 10), [10, 9, 8])
+        self.assertIsNone(self.store.get(2, 10))
+
+        self.store.remove([1], [9, 12])
+        self.assertEqual(self.store.get(1, 10), [10, 8])
+
+        self.store.invalidate(1)
+        self.assertIsNone(self.store.get(1, 10))
+
+    def test_replace_is_one_transaction(self):
+        """Are the DELETE and RPUSH of a rebuild sent as one MULTI/EXEC?"""
+
+        self.store.replace(1, [3, 2, 1])
+        self.store.replace(1, [])
+        self.assertEqual(self.client.transactions, [['delete', 'rpush'], ['delete']])
+        self.assertIsNone(self.store.get(1, 10))
+
+
+class RedisFragmentStoreTestCase(TestCase):
+    """RedisFragmentStore on its own."""
+
+    def test_get_set_delete(self):
+        client = FakeRedis()
+        store = fragment_cache.RedisFragmentStore(client, ttl=60)
+
+        self.assertEqual(store.get_many([]), {})
+        store.set_many({"a": "<p>á</p>", "b": "<p>b</p>"})
+        self.assertEqual(store.get_many(["a", "b", "c"]), {"a": "<p>á</p>", "b": "<p>b</p>"})
+        self.assertEqual(client.expiries["warbler:fragment:a"], 60)
+
+        store.delete("a")
+        self.assertEqual(store.get_many(["a", "b"]), {"b": "<p>b</p>"})
+
+
+class ConnectRedisTestCase(TestCase):
+    """Which stores an app gets, with and without REDIS_URL."""
+
+    def connected(self, **config):
+        test_app = Flask(__name__)
+        test_app.config.update(config)
+        connect_redis(test_app, client=FakeRedis() if config.get('REDIS_URL') else None)
+        timeline_cache.connect_timelines(test_app)
+        fragment_cache.connect_fragments(test_app)
+        return test_app.extensions['timelines'], test_app.extensions['fragments']
+
+    def test_redis_url(self):
+        timelines, fragments = self.connected(REDIS_URL="redis://localhost/0",
+                                              FRAGMENT_CACHE_TTL=120)
+        self.assertIsInstance(timelines, timeline_cache.RedisTimelineStore)
+        self.assertTrue(timelines.shared)
+        self.assertIsInstance(fragments, fragment_cache.RedisFragmentStore)
+        self.assertEqual(fragments.ttl, 120)
+
+    def test_in_process(self):
+        timelines, fragments = self.connected()
+        self.assertIsInstance(timelines, timeline_cache.InMemoryTimelineStore)
+        self.assertFalse(timelines.shared)
+        self.assertIsInstance(fragments, fragment_cache.InMemoryFragmentStore)
+
+
+class SharedTimelineViewTestCase(TestCase):
+    """Routes with timelines in (stand-in) Redis."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
+            author = User.signup("author", "author@test.com", "password", None)
+            follower = User.signup("follower", "follower@test.com", "password", None)
+            db.session.commit()
+            Follows.start(follower.id, author.id)
+            db.session.commit()
+            self.author_id, self.follower_id = author.id, follower.id
+
+        self.saved = app.extensions['timelines']
+        app.extensions['timelines'] = timeline_cache.RedisTimelineStore(FakeRedis())
+        self.client = app.test_client()
+
+    def test_fan_out_and_home(self):
+        """Does a new message reach a follower's Redis timeline and home page?"""
+
+        with app.app_context():
+            self.assertEqual(timeline_cache.rebuild(self.follower_id), [])
+            # an empty timeline is a missing key, so it's still cold
+            self.assertIsNone(timeline_cache.get_store().get(self.follower_id, 10))
+            Message.post(self.author_id, "Before")
+            db.session.commit()
+            timeline_cache.rebuild(self.follower_id)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.client.post("/messages/new", data={"text": "Hello from Redis"})
+
+        with app.app_context():
+            ids = [id for (id,) in db.session.query(Message.id).order_by(Message.id.desc())]
+            self.assertEqual(timeline_cache.get_store().get(self.follower_id, 10), ids)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.follower_id
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertLess(html.index("Hello from Redis"), html.index("Before"))
+
+    def tearDown(self):
+        app.extensions['timelines'] = self.saved
+        with app.app_context():
+            db.session.rollback()
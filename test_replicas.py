@@ -0,0 +1,115 @@
+"""Read replica routing tests.
+
+A second connection pool to the test database stands in for the replica.
+"""
+
+# run these tests like:
+#
+# python -m unittest -v test_replicas.py
+
+import os
+import time
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app, CURR_USER_KEY
+from models import db, User
+from replicas import PIN_KEY, Replicas
+import fragment_cache
+import timeline_cache
+import user_cache
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Which engine each request reads from."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            timeline_cache.get_store().clear()
+            fragment_cache.get_store().clear()
+            user_cache.get_cache().clear()
+
+            user = User.signup("testuser", "test@test.com", "password", None)
+            db.session.commit()
+            self.user_id = user.id
+            self.primary = db.engine
+
+        self.replica = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.saved_replicas = app.extensions['replicas']
+        app.extensions['replicas'] = Replicas([self.replica], pin_seconds=5)
+
+        self.statements = {'primary': 0, 'replica': 0}
+        event.listen(self.primary, "before_cursor_execute", self.count_primary)
+        event.listen(self.replica, "before_cursor_execute", self.count_replica)
+
+        self.client = app.test_client()
+
+    def count_primary(self, *args):
+        self.statements['primary'] += 1
+
+    def count_replica(self, *args):
+        self.statements['replica'] += 1
+
+    def get(self, url):
+        self.statements = {'primary': 0, 'replica': 0}
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return dict(self.statements)
+
+    def test_get_reads_replica(self):
+        """Do GET requests read from the replica only?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertEqual(self.get("/users")['primary'], 0)
+        statements = self.get(f"/users/{self.user_id}")
+        self.assertEqual(statements['primary'], 0)
+        self.assertGreater(statements['replica'], 0)
+
+    def test_writes_pin_primary(self):
+        """Do writes use the primary, and do later reads see them there?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.statements = {'primary': 0, 'replica': 0}
+        resp = self.client.post("/messages/new", data={"text": "Hello"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.statements['replica'], 0)
+
+        with self.client.session_transaction() as sess:
+            self.assertGreater(sess[PIN_KEY], time.time())
+
+        statements = self.get(f"/users/{self.user_id}")
+        self.assertEqual(statements['replica'], 0)
+        self.assertGreater(statements['primary'], 0)
+
+        with self.client.session_transaction() as sess:
+            sess[PIN_KEY] = time.time() - 1
+        self.assertEqual(self.get(f"/users/{self.user_id}")['primary'], 0)
+
+    def test_timeline_rebuild_reads_primary(self):
+        """Is a cold home timeline built from the primary?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.assertGreater(self.get("/")['primary'], 0)
+        self.assertEqual(self.get("/")['primary'], 0)
+
+    def tearDown(self):
+        event.remove(self.primary, "before_cursor_execute", self.count_primary)
+        event.remove(self.replica, "before_cursor_execute", self.count_replica)
+        app.extensions['replicas'] = self.saved_replicas
+        self.replica.dispose()
+
+        with app.app_context():
+            db.session.rollback()
@@ -0,0 +1,90 @@
+"""Username search backend tests."""
+
+# run these tests like:
+#
+# python -m unittest -v test_search.py
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app
+from models import db, User
+import search
+
+app.config['TESTING'] = True
+
+
+class SearchBackendTests:
+    """What every backend must answer the same way; mixed into a TestCase
+    per backend (`make_backend`)."""
+
+    def setUp(self):
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            search.reset_search()
+
+            for username in ("testuser", "testuser2", "someone_else", "Bob_100%", "alice"):
+                db.session.add(User(username=username, email=f"{username}@test.com",
+                                    password="HASHED_PASSWORD"))
+            db.session.commit()
+            self.ids = dict(db.session.query(User.username, User.id))
+
+    def names(self, user_ids):
+        by_id = {user_id: username for username, user_id in self.ids.items()}
+        return [by_id[user_id] for user_id in user_ids]
+
+    def test_ranking(self):
+        """Does the closest username come first, and unrelated ones not at all?"""
+
+        with app.app_context():
+            found = self.names(self.make_backend().search("testuser2", 10))
+            self.assertEqual(found, ["testuser2", "testuser"])
+
+    def test_similar_match(self):
+        """Is a misspelled query found by similarity (pg_trgm's `%`)?"""
+
+        with app.app_context():
+            self.assertIn("testuser2", self.names(self.make_backend().search("tsetuser2", 10)))
+
+    def test_substring_match(self):
+        """Are substrings too short to be similar found (ILIKE), literally?"""
+
+        with app.app_context():
+            backend = self.make_backend()
+            self.assertEqual(self.names(backend.search("ONE_EL", 10)), ["someone_else"])
+            self.assertEqual(self.names(backend.search("100%", 10)), ["Bob_100%"])
+            self.assertEqual(backend.search("zzzzzz", 10), [])
+
+    def test_autocomplete(self):
+        """Does autocomplete match prefixes case-insensitively, in name order?"""
+
+        with app.app_context():
+            backend = self.make_backend()
+            self.assertEqual(self.names(backend.autocomplete("TestU", 10)),
+                             ["testuser", "testuser2"])
+            self.assertEqual(self.names(backend.autocomplete("testu", 1)), ["testuser"])
+            self.assertEqual(self.names(backend.autocomplete("bob_", 10)), ["Bob_100%"])
+            self.assertEqual(backend.autocomplete("%", 10), [])
+
+
+class TrigramSearchTestCase(SearchBackendTests, TestCase):
+    """TrigramSearch, on a Postgres server with pg_trgm."""
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            if not search.has_trigram_index():
+                self.skipTest("the database server doesn't have pg_trgm")
+
+    def make_backend(self):
+        return search.TrigramSearch()
+
+
+class NgramIndexTestCase(SearchBackendTests, TestCase):
+    """NgramIndex, the fallback without pg_trgm."""
+
+    def make_backend(self):
+        return search.NgramIndex()
@@ -0,0 +1,107 @@
+"""seed.py tests."""
+
+# run these tests like:
+#
+# python -m unittest -v test_seed.py
+
+import contextlib
+import csv
+import io
+import os
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+os.environ['DATABASE_URL'] = "postgresql:///warblerdb_test"
+
+from app import app
+from models import db, User, Message, Follows, Likes
+import seed
+
+app.config['TESTING'] = True
+
+USERS = [
+    ("ann@test.com", "ann", "", "HASHED_PASSWORD", "", "", ""),
+    ("bob@test.com", "bob", "/bob.png", "HASHED_PASSWORD", "Bob's bio", "/h.jpg", "Here"),
+    ("cy@test.com", "cy", "/cy.png", "HASHED_PASSWORD", "Says \"hi\", often", "/h.jpg", ""),
+]
+MESSAGES = [(f"Message {i}", f"2020-01-{i:02} 12:00:00", 1 + i % 3) for i in range(1, 8)]
+FOLLOWS = [(1, 2), (1, 3), (2, 1), (3, 1)]
+LIKES = [(1, 7), (2, 7), (3, 6), (1, 2)]
+
+
+class SeedTestCase(TestCase):
+    """Loading CSVs, and carrying on after an interrupted load."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.write_csv('users.csv', ("email", "username", "image_url", "password",
+                                     "bio", "header_image_url", "location"), USERS)
+        self.write_csv('messages.csv', ("text", "timestamp", "user_id"), MESSAGES)
+        self.write_csv('follows.csv', ("user_being_followed_id", "user_following_id"), FOLLOWS)
+        self.write_csv('likes.csv', ("user_id", "message_id"), LIKES)
+
+    def write_csv(self, filename, columns, rows):
+        with open(os.path.join(self.data_dir, filename), 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+    def test_read_chunks(self):
+        """Are chunks cut at chunk_size, after skipping loaded rows?"""
+
+        path = os.path.join(self.data_dir, 'messages.csv')
+        chunks = [rows for columns, rows in seed.read_chunks(path, 3, skip=2)]
+        self.assertEqual([len(rows) for rows in chunks], [3, 2])
+        self.assertEqual(chunks[0][0][0], "Message 3")
+
+    def test_resume(self):
+        """Does --resume finish an interrupted load as if it had never stopped?"""
+
+        copy_chunk = seed.copy_chunk
+        calls = []
+
+        def interrupted(connection, table, columns, rows):
+            # the third chunk of messages.csv is sent, then the load dies
+            copy_chunk(connection, table, columns, rows)
+            calls.append(table)
+            if calls.count('messages') == 3:
+                raise KeyboardInterrupt
+
+        with app.app_context(), contextlib.redirect_stderr(io.StringIO()):
+            with mock.patch.object(seed, 'copy_chunk', interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    seed.seed(self.data_dir, chunk_size=2)
+            self.assertEqual(Message.query.count(), 4)
+            self.assertEqual(Follows.query.count(), 0)
+            db.session.commit()
+
+            argv = ["seed.py", "--data-dir", self.data_dir, "--chunk-size", "2", "--resume"]
+            with mock.patch.object(sys, 'argv', argv):
+                seed.main()
+
+            self.assertEqual([User.query.count(), Message.query.count(),
+                              Follows.query.count(), Likes.query.count()],
+                             [len(USERS), len(MESSAGES), len(FOLLOWS), len(LIKES)])
+
+            # ids follow CSV order, so follows and likes point at the right rows
+            self.assertEqual([(m.id, m.text) for m in Message.query.order_by(Message.id)],
+                             [(i, text) for i, (text, timestamp, user_id) in enumerate(MESSAGES, 1)])
+
+            ann = db.session.get(User, 1)
+            self.assertEqual((ann.messages_count, ann.following_count,
+                              ann.followers_count, ann.likes_count), (2, 2, 2, 2))
+            self.assertEqual(db.session.get(Message, 7).likes_count, 2)
+
+            # QUOTE_ALL: empty strings stay empty strings, not NULL
+            self.assertEqual((ann.bio, ann.location, ann.image_url), ("", "", ""))
+            self.assertEqual(db.session.get(User, 3).bio, 'Says "hi", often')
+
+            # new rows get ids past the loaded ones
+            user = User.signup("dee", "dee@test.com", "password", None)
+            db.session.commit()
+            self.assertEqual(user.id, len(USERS) + 1)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.rollback()
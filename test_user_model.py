@@ -7,9 +7,13 @@
 # python -m unittest -v test_user_model.py
 
 import os
+import threading
+import time
+from datetime import datetime
 from unittest import TestCase
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, reconcile_counters
 from app import app
+from passwords import get_hasher, cost_of
 from sqlalchemy import exc
 
 # BEFORE we import our app, let's set an environmental variable
@@ -122,6 +126,141 @@ class UserModelTestCase(TestCase):
             self.assertTrue(u2.is_followed_by(u1))
             self.assertFalse(u2.is_following(u1))
 
+    def test_concurrent_follow(self):
+        """Does losing a race to make the same follow change nothing?"""
+
+        with app.app_context():
+            u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD1")
+            u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD2")
+            db.session.add_all([u1, u2])
+            db.session.commit()
+            u1_id, u2_id = u1.id, u2.id
+
+            results = []
+
+            def follow():
+                with app.app_context():
+                    results.append(Follows.start(u1_id, u2_id))
+                    db.session.commit()
+
+            # another request has inserted the row but not committed yet
+            with db.engine.connect() as other:
+                other.execute(db.text(
+                    "INSERT INTO follows (user_being_followed_id, user_following_id) "
+                    "VALUES (:followed, :follower)"), {"followed": u2_id, "follower": u1_id})
+                thread = threading.Thread(target=follow)
+                thread.start()
+                time.sleep(0.2)
+                other.commit()
+            thread.join()
+
+            self.assertEqual(results, [False])
+            db.session.expire_all()
+            self.assertEqual(db.session.get(User, u1_id).following_count, 0)
+
+    def test_follow_created_at_utc(self):
+        """Do follows made by the app and by bulk loads get the same clock?"""
+
+        with app.app_context():
+            u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD1")
+            u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD2")
+            db.session.add_all([u1, u2])
+            db.session.commit()
+
+            db.session.execute(db.text("SET LOCAL TIME ZONE 'America/New_York'"))
+            Follows.start(u1.id, u2.id)
+            db.session.execute(db.text(
+                "INSERT INTO follows (user_being_followed_id, user_following_id) VALUES (:a, :b)"),
+                {"a": u1.id, "b": u2.id})
+            db.session.commit()
+
+            app_made, loaded = [follow.created_at for follow in
+                                Follows.query.order_by(Follows.user_being_followed_id.desc())]
+            self.assertLess(abs((loaded - app_made).total_seconds()), 60)
+
+    def test_user_timestamps_utc(self):
+        """Do bulk-loaded users get UTC timestamps, like the app's utcnow?"""
+
+        with app.app_context():
+            db.session.execute(db.text("SET LOCAL TIME ZONE 'America/New_York'"))
+            db.session.execute(db.text(
+                "INSERT INTO users (email, username, password) VALUES ('bulk@test.com', 'bulk', 'x')"))
+            db.session.commit()
+
+            user = User.query.filter_by(username="bulk").one()
+            for column in (user.updated_at, user.profile_updated_at):
+                self.assertLess(abs((column - datetime.utcnow()).total_seconds()), 60)
+
+    def test_reconcile_counters(self):
+        """Does reconcile_counters recompute counters from the rows?"""
+
+        with app.app_context():
+            u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD1")
+            u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD2")
+            db.session.add_all([u1, u2])
+            db.session.commit()
+
+            # Added behind the counters' back, like seed.py does
+            m = Message(text="warble", user_id=u2.id)
+            db.session.add_all([m, Follows(user_being_followed_id=u2.id, user_following_id=u1.id)])
+            db.session.commit()
+            db.session.add(Likes(user_id=u1.id, message_id=m.id))
+            db.session.commit()
+
+            self.assertEqual(u2.messages_count, 0)
+
+            reconcile_counters()
+            db.session.commit()
+            db.session.expire_all()
+
+            self.assertEqual((u1.following_count, u1.followers_count, u1.likes_count), (1, 0, 1))
+            self.assertEqual((u2.following_count, u2.followers_count, u2.messages_count), (0, 1, 1))
+            self.assertEqual(m.likes_count, 1)
+
+    def test_purge_batch(self):
+        """Does purging a deleted account go in bounded batches and keep counters right?"""
+
+        with app.app_context():
+            users = [User(email=f"test{n}@test.com", username=f"testuser{n}", password="HASHED")
+                     for n in range(4)]
+            db.session.add_all(users)
+            db.session.commit()
+            gone, others = users[0], users[1:]
+
+            for user in others:
+                Follows.start(user.id, gone.id)
+                Follows.start(gone.id, user.id)
+            messages = [Message.post(user.id, "warble") for user in users for _ in range(2)]
+            db.session.flush()
+            for user in users:
+                for msg in messages:
+                    Likes.toggle(user.id, msg.id)
+            gone.deleted_at = datetime.utcnow()
+            db.session.commit()
+
+            self.assertFalse(User.authenticate(gone.username, "HASHED"))
+
+            batches = []
+            while True:
+                batches.append(User.purge_batch(gone.id, batch_size=2))
+                db.session.commit()
+                if not batches[-1]:
+                    break
+
+            self.assertTrue(all(0 < batch <= 2 for batch in batches[:-1]))
+            self.assertIsNone(db.session.get(User, gone.id))
+
+            counters = [(u.following_count, u.followers_count, u.likes_count, u.messages_count)
+                        for u in others]
+            likes = [m.likes_count for m in messages[2:]]
+            reconcile_counters()
+            db.session.commit()
+            db.session.expire_all()
+            self.assertEqual(counters, [(u.following_count, u.followers_count, u.likes_count,
+                                         u.messages_count) for u in others])
+            self.assertEqual(likes, [m.likes_count for m in messages[2:]])
+            self.assertEqual(counters[0], (0, 0, 6, 2))
+
     # Does User.create successfully create a new user given valid credentials?
     # Does User.create fail to create a new user if any of the validations (e.g. uniqueness, non-nullable fields) fail?
 
@@ -241,6 +380,29 @@ class UserModelTestCase(TestCase):
 
             self.assertFalse(authenticated_user)
 
+    def test_authenticate_rehashes_on_cost_change(self):
+        """Does a successful login upgrade a hash made with an old cost?"""
+
+        with app.app_context():
+            hasher = get_hasher()
+            configured_rounds = hasher.rounds
+            try:
+                hasher.rounds = 4
+                user = User.signup(username="testuser", email="test@test.com",
+                                   password="password", image_url=None)
+                db.session.commit()
+                self.assertEqual(cost_of(user.password), 4)
+
+                hasher.rounds = 5
+                self.assertFalse(User.authenticate("testuser", "wrong_password"))
+                self.assertEqual(cost_of(user.password), 4)
+
+                self.assertEqual(User.authenticate("testuser", "password"), user)
+                self.assertEqual(cost_of(user.password), 5)
+                self.assertTrue(hasher.check(user.password, "password"))
+            finally:
+                hasher.rounds = configured_rounds
+
     def tearDown(self): 
         with app.app_context():
             db.session.rollback()
@@ -1,8 +1,13 @@
 from app import app, CURR_USER_KEY
+from datetime import datetime, timedelta
 from unittest import TestCase
-from models import db, connect_db, User, Message, Follows, Likes
+from models import db, connect_db, User, Message, Follows, Likes, parse_cursor
 from flask import session
 from forms import UserEditForm
+import fragment_cache
+import timeline_cache
+import user_cache
+import search
 
 # run these tests like:
 #
@@ -24,6 +29,9 @@ class UserViewTestCase(TestCase):
         with app.app_context():
             db.drop_all()
             db.create_all()
+            user_cache.get_cache().clear()
+            fragment_cache.get_store().clear()
+            search.reset_search()
 
             self.client = app.test_client()
 
@@ -55,6 +63,83 @@ class UserViewTestCase(TestCase):
                 self.assertIn("@testuser", html)
                 self.assertIn("@testuser2", html)
 
+    def test_list_users_pagination(self):
+        """Does the directory page through users with the `after` id?"""
+        with app.app_context():
+            app.config['USERS_PER_PAGE'] = 1
+            try:
+                with self.client as c:
+                    html = c.get("/users").get_data(as_text=True)
+                    self.assertIn("@testuser<", html)
+                    self.assertNotIn("@testuser2", html)
+                    self.assertIn(f'href="/users?after={self.user_id}"', html)
+
+                    html = c.get(f"/users?after={self.user_id}").get_data(as_text=True)
+                    self.assertIn("@testuser2", html)
+                    self.assertNotIn("@testuser<", html)
+                    self.assertNotIn('id="more-users"', html)
+            finally:
+                app.config['USERS_PER_PAGE'] = 30
+
+    def test_list_users_follow_state(self):
+        """Do user cards show Unfollow only for followed users?"""
+        with app.app_context():
+            db.session.add(Follows(user_being_followed_id=self.user_id+1,
+                                   user_following_id=self.user_id))
+            db.session.commit()
+
+            self.assertEqual(Follows.followed_among(self.user_id, [self.user_id, self.user_id+1]),
+                             {self.user_id+1})
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                resp = c.get("/users")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn(f'action="/users/stop-following/{self.user_id+1}"', html)
+                self.assertIn(f'action="/users/follow/{self.user_id}"', html)
+                self.assertNotIn(f'action="/users/follow/{self.user_id+1}"', html)
+
+    def test_search_users(self):
+        """Does search find substring and near matches, best match first?"""
+        with app.app_context():
+            User.signup(username="someone_else", email="else@test.com",
+                        password="password", image_url=None)
+            db.session.commit()
+
+            with self.client as c:
+                html = c.get("/users?q=testuser2").get_data(as_text=True)
+                self.assertIn("@testuser2", html)
+                self.assertLess(html.index("@testuser2"), html.index("@testuser<"))
+                self.assertNotIn("@someone_else", html)
+
+                html = c.get("/users?q=tsetuser2").get_data(as_text=True)
+                self.assertIn("@testuser2", html)
+
+                html = c.get("/users?q=zzzzzz").get_data(as_text=True)
+                self.assertIn("Sorry, no users found", html)
+
+    def test_users_autocomplete(self):
+        """Does autocomplete return users by username prefix?"""
+        with app.app_context():
+            with self.client as c:
+                resp = c.get("/users/autocomplete?q=TestU")
+                self.assertEqual([u["username"] for u in resp.get_json()["users"]],
+                                 ["testuser", "testuser2"])
+
+                # users who sign up later are picked up too
+                User.signup(username="testuser3", email="test3@test.com",
+                            password="password", image_url=None)
+                db.session.commit()
+
+                resp = c.get("/users/autocomplete?q=testuser3")
+                self.assertEqual([u["username"] for u in resp.get_json()["users"]], ["testuser3"])
+
+                resp = c.get("/users/autocomplete?q=nobody")
+                self.assertEqual(resp.get_json(), {"users": []})
+
     def test_users_show(self):
         """Can we successfully retrieve a user's profile page?"""
         with app.app_context():
@@ -65,6 +150,52 @@ class UserViewTestCase(TestCase):
                 self.assertEqual(resp.status_code, 200)
                 self.assertIn("@testuser", html)
 
+    def test_current_user_cache(self):
+        """Is g.user served from the snapshot cache until the user changes?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.get("/users")
+                self.assertEqual(user_cache.get_cache().get(self.user_id).username, "testuser")
+
+                user = User.query.get(self.user_id)
+                user.username = "renamed"
+                db.session.commit()
+                self.assertIsNone(user_cache.get_cache().get(self.user_id))
+
+                resp = c.get("/users")
+                self.assertIn('alt="renamed"', resp.get_data(as_text=True))
+
+    def test_users_show_pagination(self):
+        """Do profile messages page through with the `before` cursor?"""
+        with app.app_context():
+            start = datetime(2023, 1, 1)
+            for i in range(25):
+                db.session.add(Message(text=f"warble number {i}",
+                                       timestamp=start + timedelta(minutes=i),
+                                       user_id=self.user_id))
+            db.session.commit()
+
+            with self.client as c:
+                resp = c.get(f"/users/{self.user_id}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("warble number 24<", html)
+                self.assertIn("warble number 5<", html)
+                self.assertNotIn("warble number 4<", html)
+                self.assertIn('id="older-messages"', html)
+
+                newest_on_page = Message.query.filter_by(text="warble number 5").one()
+                resp = c.get(f"/users/{self.user_id}", query_string={"before": newest_on_page.cursor})
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("warble number 4<", html)
+                self.assertIn("warble number 0<", html)
+                self.assertNotIn("warble number 5<", html)
+                self.assertNotIn('id="older-messages"', html)
+
     def test_show_following(self):
         """Can we successfully retrieve a list of people this user is following?"""
         with app.app_context():
@@ -72,6 +203,43 @@ class UserViewTestCase(TestCase):
                 resp = c.get(f"/users/{self.user_id}/following", follow_redirects=True)
                 self.assertEqual(resp.status_code, 200) 
 
+    def test_follow_list_pagination(self):
+        """Do following/followers pages list newest follows first, a page at a time?"""
+        with app.app_context():
+            start = datetime(2023, 1, 1)
+            fans = [User(email=f"fan{i}@test.com", username=f"fan{i}", password="HASHED")
+                    for i in range(5)]
+            db.session.add_all(fans)
+            db.session.flush()
+            for i, fan in enumerate(fans):
+                db.session.add(Follows(user_being_followed_id=self.user_id, user_following_id=fan.id,
+                                       created_at=start + timedelta(minutes=i)))
+            db.session.commit()
+
+            users, next_cursor = User.follow_list(self.user_id, followers=True, per_page=3)
+            self.assertEqual([user.username for user in users], ["fan4", "fan3", "fan2"])
+
+            users, last_cursor = User.follow_list(self.user_id, followers=True,
+                                                  before=parse_cursor(next_cursor), per_page=3)
+            self.assertEqual([user.username for user in users], ["fan1", "fan0"])
+            self.assertIsNone(last_cursor)
+
+            users, next_cursor = User.follow_list(fans[0].id, per_page=3)
+            self.assertEqual([user.id for user in users], [self.user_id])
+
+            app.config['USERS_PER_PAGE'], saved = 3, app.config['USERS_PER_PAGE']
+            try:
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = self.user_id
+                    html = c.get(f"/users/{self.user_id}/followers").get_data(as_text=True)
+            finally:
+                app.config['USERS_PER_PAGE'] = saved
+
+            self.assertIn("@fan4", html)
+            self.assertNotIn("@fan1", html)
+            self.assertIn('id="more-users"', html)
+
     def test_users_followers(self):
         """Can we successfully retrieve a list of followers of this user?"""
         with app.app_context():
@@ -99,6 +267,125 @@ class UserViewTestCase(TestCase):
                 u2 = User.query.get(self.user_id+1)
                 self.assertIn(u2, u.following)
 
+    def test_unfollow_refills_home(self):
+        """After an unfollow, does home show the accounts still followed?"""
+
+        saved = app.extensions['timelines']
+        app.extensions['timelines'] = timeline_cache.InMemoryTimelineStore(max_length=10)
+        try:
+            with app.app_context():
+                u3 = User.signup(username="testuser3", email="test3@test.com",
+                                 password="testuser3", image_url=None)
+                db.session.commit()
+                start = datetime(2023, 1, 1)
+                for n in range(5):
+                    db.session.add(Message(text=f"quiet {n}", user_id=u3.id,
+                                           timestamp=start + timedelta(minutes=n)))
+                # newer than all of u3's, and more than the cached timeline holds
+                for n in range(12):
+                    db.session.add(Message(text=f"loud {n}", user_id=self.user_id + 1,
+                                           timestamp=start + timedelta(hours=1, minutes=n)))
+                db.session.commit()
+                u3_id = u3.id
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.post(f"/users/follow/{self.user_id + 1}")
+                c.post(f"/users/follow/{u3_id}")
+                self.assertNotIn("quiet 4", c.get("/").get_data(as_text=True))
+
+                c.post(f"/users/stop-following/{self.user_id + 1}")
+                html = c.get("/").get_data(as_text=True)
+                self.assertNotIn("loud", html)
+                for n in range(5):
+                    self.assertIn(f"quiet {n}", html)
+        finally:
+            app.extensions['timelines'] = saved
+
+    def test_follow_counters(self):
+        """Do follow and unfollow keep both users' counters up to date?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                c.get("/")  # cache the current-user snapshot
+                c.post(f"/users/follow/{self.user_id+1}")
+                c.post(f"/users/follow/{self.user_id+1}")
+
+                resp = c.get("/")
+                self.assertIn(f'<a href="/users/{self.user_id}/following">1</a>',
+                              resp.get_data(as_text=True))
+                resp = c.get(f"/users/{self.user_id+1}")
+                self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+                u = User.query.get(self.user_id)
+                u2 = User.query.get(self.user_id+1)
+                self.assertEqual(u.following_count, 1)
+                self.assertEqual(u2.followers_count, 1)
+
+                c.post(f"/users/stop-following/{self.user_id+1}")
+
+                db.session.expire_all()
+                self.assertEqual(u.following_count, 0)
+                self.assertEqual(u2.followers_count, 0)
+                self.assertNotIn(u2, u.following)
+
+    def test_users_show_conditional(self):
+        """Does a profile answer 304 until the user or the viewer changes?"""
+        with app.app_context():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+
+                url = f"/users/{self.user_id+1}"
+                resp = c.get(url)
+                etag = resp.headers["ETag"]
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("private", resp.headers["Cache-Control"])
+                self.assertNotIn("no-store", resp.headers["Cache-Control"])
+
+                resp = c.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(resp.get_data(), b"")
+
+                # following them changes both users' counters
+                c.post(f"/users/follow/{self.user_id+1}")
+                resp = c.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotEqual(resp.headers["ETag"], etag)
+                self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+                # another viewer never gets this viewer's page
+                etag = resp.headers["ETag"]
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id + 1
+                resp = c.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 200)
+
+    def test_cache_headers(self):
+        """Are static files cacheable and other pages never stored?"""
+        with app.app_context():
+            with self.client as c:
+                resp = c.get("/static/stylesheets/style.css?v=1")
+                self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+                self.assertIn("immutable", resp.headers["Cache-Control"])
+
+                resp = c.get("/static/stylesheets/style.css")
+                self.assertIn(f"max-age={app.config['STATIC_MAX_AGE']}", resp.headers["Cache-Control"])
+                self.assertIn("public", resp.headers["Cache-Control"])
+
+                html = c.get("/login").get_data(as_text=True)
+                self.assertRegex(html, r'href="/static/stylesheets/style.css\?v=\d+"')
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+                resp = c.get("/users")
+                self.assertIn("no-store", resp.headers["Cache-Control"])
+                self.assertIn("private", resp.headers["Cache-Control"])
+
     def test_user_edit_route(self):
         """Test user edit route."""
         with app.app_context():
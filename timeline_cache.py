@@ -0,0 +1,254 @@
+"""Precomputed home timelines (fan-out-on-write).
+
+When someone posts, the new message id is pushed onto the cached timeline of
+the author and of everyone following them. The home page then reads the
+newest ids straight out of the store instead of querying across every
+account the user follows.
+
+Two backends are provided: an in-process store (the default; fine for a
+single worker and for tests) and one that talks to any Redis-like client,
+used when REDIS_URL is set (see redis_client.py).
+"""
+
+import logging
+import threading
+from collections import deque
+
+from flask import current_app
+
+from models import db, Follows, Message, Timeline
+from replicas import use_primary
+
+logger = logging.getLogger(__name__)
+
+# How many message ids we keep per user. The home page only reads the first
+# page from here, the rest is headroom so deletes/unfollows don't leave it short.
+TIMELINE_LENGTH = 800
+
+
+class TimelineStore:
+    """Interface every timeline backend implements.
+
+    A timeline is a list of message ids, newest first. A user whose timeline
+    hasn't been built yet is "cold": `get` returns None for them and pushes
+    to them are ignored, since building it later will pick the new message
+    up from the database anyway.
+    """
+
+    # Whether every process sees the same timelines. Only then may the
+    # `flask run-jobs` worker update them on the web workers' behalf.
+    shared = False
+
+    def get(self, user_id, limit):
+        """Return up to `limit` newest message ids, or None if cold."""
+
+        raise NotImplementedError
+
+    def push(self, user_ids, message_id):
+        """Prepend `message_id` to each (warm) timeline in `user_ids`."""
+
+        raise NotImplementedError
+
+    def remove(self, user_ids, message_ids):
+        """Drop `message_ids` from each timeline in `user_ids`."""
+
+        raise NotImplementedError
+
+    def replace(self, user_id, message_ids):
+        """Store a freshly built timeline for `user_id`."""
+
+        raise NotImplementedError
+
+    def invalidate(self, user_id):
+        """Forget `user_id`'s timeline so it's rebuilt on next read."""
+
+        raise NotImplementedError
+
+
+class InMemoryTimelineStore(TimelineStore):
+    """Timelines kept in a dict in this process.
+
+    Every worker process has its own copy, so only use this when running a
+    single worker (dev, tests); otherwise plug in a shared backend.
+    """
+
+    def __init__(self, max_length=TIMELINE_LENGTH):
+        self.max_length = max_length
+        self._timelines = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, limit):
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is None:
+                return None
+            return list(timeline)[:limit]
+
+    def push(self, user_ids, message_id):
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is not None:
+                    timeline.appendleft(message_id)
+
+    def remove(self, user_ids, message_ids):
+        message_ids = set(message_ids)
+        with self._lock:
+            for user_id in user_ids:
+                timeline = self._timelines.get(user_id)
+                if timeline is not None:
+                    self._timelines[user_id] = deque(
+                        (id for id in timeline if id not in message_ids),
+                        maxlen=self.max_length)
+
+    def replace(self, user_id, message_ids):
+        with self._lock:
+            self._timelines[user_id] = deque(message_ids, maxlen=self.max_length)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._timelines.pop(user_id, None)
+
+    def clear(self):
+        """Forget every timeline."""
+
+        with self._lock:
+            self._timelines.clear()
+
+
+class RedisTimelineStore(TimelineStore):
+    """Timelines kept in Redis lists, shared by every worker.
+
+    `client` can be a redis-py client or anything else with the same
+    lpushx/ltrim/lrange/lrem/rpush/delete/exists/pipeline methods (e.g. a
+    local stand-in for development). An empty timeline is stored as a missing key,
+    so users with nothing to see are simply rebuilt each time.
+    """
+
+    shared = True
+
+    def __init__(self, client, prefix="warbler:timeline:", max_length=TIMELINE_LENGTH):
+        self.client = client
+        self.prefix = prefix
+        self.max_length = max_length
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def get(self, user_id, limit):
+        key = self._key(user_id)
+        if not self.client.exists(key):
+            return None
+        return [int(id) for id in self.client.lrange(key, 0, limit - 1)]
+
+    def push(self, user_ids, message_id):
+        for user_id in user_ids:
+            key = self._key(user_id)
+            # LPUSHX only pushes onto lists that already exist, which is
+            # exactly the "ignore cold users" rule.
+            if self.client.lpushx(key, message_id):
+                self.client.ltrim(key, 0, self.max_length - 1)
+
+    def remove(self, user_ids, message_ids):
+        for user_id in user_ids:
+            key = self._key(user_id)
+            for message_id in message_ids:
+                self.client.lrem(key, 0, message_id)
+
+    def replace(self, user_id, message_ids):
+        key = self._key(user_id)
+        message_ids = list(message_ids)[:self.max_length]
+        # one MULTI/EXEC: readers never see the list missing or half written,
+        # and a concurrent push can't slip in between the delete and the rpush
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(key)
+        if message_ids:
+            pipe.rpush(key, *message_ids)
+        pipe.execute()
+
+    def invalidate(self, user_id):
+        self.client.delete(self._key(user_id))
+
+
+def connect_timelines(app, store=None):
+    """Attach a timeline store to the app: in Redis if connect_redis gave it
+    a client, else an in-process one."""
+
+    redis = app.extensions.get('redis')
+    if store is None and redis is not None:
+        store = RedisTimelineStore(redis)
+    elif store is None:
+        store = InMemoryTimelineStore()
+        if app.config.get('WEB_CONCURRENCY', 1) > 1:
+            logger.warning("In-process timelines with %s worker processes: each one only "
+                           "sees its own fan-out; set REDIS_URL",
+                           app.config['WEB_CONCURRENCY'])
+
+    app.extensions['timelines'] = store
+
+
+def get_store():
+    """Return the timeline store of the current app."""
+
+    return current_app.extensions['timelines']
+
+
+def _audience(author_id):
+    """Ids of everyone whose home timeline shows `author_id`'s messages."""
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == author_id))
+    return [author_id] + [user_id for (user_id,) in followers]
+
+
+def rebuild(user_id):
+    """Build `user_id`'s timeline from the database and store it.
+
+    Reads the primary: a lagging replica could miss a message that was fanned
+    out before this timeline existed, and it would never show up.
+    """
+
+    use_primary()
+    message_ids = Timeline.home(user_id).message_ids(get_store().max_length)
+    get_store().replace(user_id, message_ids)
+    return message_ids
+
+
+def home_message_ids(user_id, limit):
+    """Newest `limit` message ids for `user_id`'s home page."""
+
+    message_ids = get_store().get(user_id, limit)
+    if message_ids is None:
+        message_ids = rebuild(user_id)[:limit]
+    return message_ids
+
+
+def fan_out(message, to_author=True):
+    """Push a just-committed message onto its audience's timelines.
+
+    With `to_author=False` only its author's followers get it (the route
+    pushes to the author itself and leaves the rest to a job).
+    """
+
+    audience = _audience(message.user_id)
+    get_store().push(audience if to_author else audience[1:], message.id)
+
+
+def retract(message):
+    """Remove a message from its audience's timelines."""
+
+    get_store().remove(_audience(message.user_id), [message.id])
+
+
+def retract_author(author_id):
+    """Forget the timelines of everyone who sees `author_id`'s messages (deleted account).
+
+    One query for the audience, then one store call per warm timeline; the
+    timelines are rebuilt, without the account, when next read. Must run
+    before the account's follows are purged, while its audience is known.
+    """
+
+    store = get_store()
+    for user_id in _audience(author_id):
+        store.invalidate(user_id)
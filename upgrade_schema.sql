@@ -0,0 +1,115 @@
+-- Brings a database made from warblerdb_bck.sql (or by an earlier version
+-- of models.py) up to the current schema. db.create_all() only creates
+-- missing tables, never columns, constraints or indexes, so run this on
+-- existing databases:
+--
+--     psql warblerdb -f upgrade_schema.sql
+--     flask reconcile-counters
+--
+-- The new counter columns start at 0; reconcile-counters fills them in.
+-- Existing follows all get the time of the upgrade as created_at; pages
+-- order them among themselves by user id. Safe to run more than once.
+
+BEGIN;
+
+-- users: denormalized counters, change times, soft deletion
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS messages_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS following_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS followers_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS updated_at timestamp without time zone
+        NOT NULL DEFAULT timezone('utc', now()),
+    ADD COLUMN IF NOT EXISTS profile_updated_at timestamp without time zone
+        NOT NULL DEFAULT timezone('utc', now()),
+    ADD COLUMN IF NOT EXISTS deleted_at timestamp without time zone;
+
+-- earlier versions defaulted to now(), in the session's time zone
+ALTER TABLE users ALTER COLUMN updated_at SET DEFAULT timezone('utc', now());
+
+-- username prefix autocomplete (see search.py)
+CREATE INDEX IF NOT EXISTS ix_users_username_prefix
+    ON users (lower(username) text_pattern_ops);
+
+-- messages: like counter and the profile/timeline indexes
+
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS likes_count integer NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp
+    ON messages (user_id, "timestamp" DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_messages_timestamp
+    ON messages ("timestamp" DESC, id DESC);
+
+-- likes: keyed by (user_id, message_id) instead of a surrogate id. The old
+-- schema also made message_id unique, so only one user could like a message.
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM information_schema.columns
+               WHERE table_schema = current_schema()
+                 AND table_name = 'likes' AND column_name = 'id') THEN
+        DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL;
+        DELETE FROM likes AS later USING likes AS earlier
+            WHERE later.user_id = earlier.user_id
+              AND later.message_id = earlier.message_id
+              AND later.id > earlier.id;
+
+        ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+        ALTER TABLE likes DROP CONSTRAINT likes_pkey;
+        ALTER TABLE likes DROP COLUMN id;
+        ALTER TABLE likes
+            ALTER COLUMN user_id SET NOT NULL,
+            ALTER COLUMN message_id SET NOT NULL,
+            ADD CONSTRAINT likes_pkey PRIMARY KEY (user_id, message_id);
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id);
+
+-- follows: when each one was made, for the follower/following pages
+
+ALTER TABLE follows
+    ADD COLUMN IF NOT EXISTS created_at timestamp without time zone
+    NOT NULL DEFAULT timezone('utc', now());
+
+CREATE INDEX IF NOT EXISTS ix_follows_following_created_at
+    ON follows (user_following_id, created_at DESC, user_being_followed_id DESC);
+CREATE INDEX IF NOT EXISTS ix_follows_followed_created_at
+    ON follows (user_being_followed_id, created_at DESC, user_following_id DESC);
+
+-- jobs: the background job queue (see jobs.py)
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id serial PRIMARY KEY,
+    name text NOT NULL,
+    payload json NOT NULL,
+    idempotency_key text UNIQUE,
+    status text NOT NULL,
+    attempts integer NOT NULL,
+    max_attempts integer NOT NULL,
+    run_at timestamp without time zone NOT NULL,
+    locked_at timestamp without time zone,
+    finished_at timestamp without time zone,
+    last_error text
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at);
+
+COMMIT;
+
+-- Username search by similarity, where the server has pg_trgm; without it
+-- the app falls back to an in-process index (see search.py). Outside the
+-- transaction above so a missing extension doesn't undo the rest.
+
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+        ON users USING gin (username gin_trgm_ops);
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm unavailable, skipping the trigram index: %', SQLERRM;
+END
+$$;
@@ -0,0 +1,155 @@
+"""Per-process cache of the logged-in user, for add_user_to_g.
+
+Every request used to start with a SELECT for the current user. Instead we
+keep a small, immutable snapshot of the columns pages show for them (name,
+avatar, the counters on the home page, ...) in a bounded TTL/LRU cache.
+g.user serves those fields from the snapshot and only loads the real User
+row when a route touches anything else (relationships) or needs the ORM
+object to change it.
+
+Snapshots are dropped whenever SQLAlchemy updates or deletes a User or
+models.adjust_counters moves a user's counters, and expire after
+USER_CACHE_TTL seconds so other worker processes catch up.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from models import db, User
+
+UserSnapshot = namedtuple("UserSnapshot", [
+    "id", "username", "email", "image_url", "header_image_url", "bio", "location",
+    "messages_count", "following_count", "followers_count",
+])
+
+
+class SnapshotCache:
+    """Bounded LRU of UserSnapshots whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Cached snapshot for `user_id`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires_at, snapshot = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, snapshot):
+        with self._lock:
+            self._entries[snapshot.id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(snapshot.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CurrentUser:
+    """What add_user_to_g puts on g.user.
+
+    Snapshot fields come from the cache; any other attribute is looked up on
+    the full User, which is loaded on first use. Call `load()` to get that
+    User itself, e.g. to delete it.
+    """
+
+    def __init__(self, snapshot, user=None):
+        self._snapshot = snapshot
+        self._user = user
+
+    def load(self):
+        """The ORM User for this snapshot (loaded once per request)."""
+
+        if self._user is None:
+            self._user = db.session.get(User, self._snapshot.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name in UserSnapshot._fields:
+            return getattr(self._snapshot, name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<User #{self.id}: {self.username}, {self.email}>"
+
+
+def connect_user_cache(app):
+    """Attach a current-user cache to the app."""
+
+    app.extensions['user_cache'] = SnapshotCache(
+        max_size=app.config.get('USER_CACHE_SIZE', 1024),
+        ttl=app.config.get('USER_CACHE_TTL', 60))
+
+
+def get_cache():
+    """Return the current-user cache of the current app."""
+
+    return current_app.extensions['user_cache']
+
+
+def load_current_user(user_id):
+    """A CurrentUser for `user_id`, or None if there's no such user."""
+
+    cache = get_cache()
+    snapshot = cache.get(user_id)
+    if snapshot is not None:
+        return CurrentUser(snapshot)
+
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        return None
+
+    snapshot = UserSnapshot(*(getattr(user, field) for field in UserSnapshot._fields))
+    cache.put(snapshot)
+    return CurrentUser(snapshot, user)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target):
+    """Drop the snapshot now, and again once the change is committed.
+
+    The second drop covers a request that re-cached the old row between
+    our flush and commit.
+    """
+
+    if not has_app_context() or 'user_cache' not in current_app.extensions:
+        return
+
+    get_cache().invalidate(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_user_ids', set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    changed = session.info.pop('changed_user_ids', None)
+    if changed and has_app_context():
+        for user_id in changed:
+            get_cache().invalidate(user_id)